@@ -0,0 +1,176 @@
+# Columnar export of the game database for offline analytics
+# The results table is written as a Parquet dataset partitioned by gameid and
+# gametype (hive layout: <dir>/results/gameid=<id>/gametype=<type>/*.parquet),
+# with typed columns, and the games table as a single Parquet file. Exports
+# are incremental: the state file keeps the last results id exported, so each
+# run only appends the rows inserted since. Deleted games (game_deletions) are
+# removed from the dataset and the ids they freed are exported again.
+#
+# pyarrow is optional and only imported here:
+#     python analytics.py export analytics/
+#     python analytics.py load analytics/ --gameid 12345
+
+import argparse
+import json
+import os
+import shutil
+
+import db
+import schema
+from schema import RESULTS_COLUMNS
+
+EXPORT_CHUNK = 100000          # rows per Parquet file written
+STATE_FILE = '_export_state.json'
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The analytics export needs pyarrow (pip install pyarrow)") from None
+    return pyarrow
+
+
+def results_schema(pa):
+    """Arrow schema of the exported results (gameid and gametype are the partition keys)"""
+    return pa.schema([
+        ('id', pa.int64()),
+        ('timestamp', pa.timestamp('us')),
+        ('gameid', pa.int64()),
+        ('gametype', pa.string()),
+        ('groupid', pa.string()),
+        ('period', pa.int16()),
+        ('price', pa.float64()),
+        ('ncust', pa.int32()),
+        ('sales', pa.int32()),
+        ('end_inv', pa.int32()),
+    ])
+
+
+def games_schema(pa):
+    return pa.schema([
+        ('gameid', pa.int64()),
+        ('gamestatus', pa.string()),
+        ('timestamp', pa.timestamp('us')),
+    ])
+
+
+def partitioning(pa):
+    return pa.dataset.partitioning(pa.schema([('gameid', pa.int64()), ('gametype', pa.string())]),
+                                   flavor='hive')
+
+
+def _to_table(pa, rows, schema):
+    """Arrow table from rows of the columns of schema (timestamps stored as text in SQLite)"""
+    import pandas as pd
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_timestamp(field.type):
+            values = pd.to_datetime(pd.Series(values), errors='coerce')
+        arrays.append(pa.array(values, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def read_state(out_dir):
+    """Export state: last results id and last game deletion exported"""
+    try:
+        with open(os.path.join(out_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'results_id': 0, 'deletion_id': 0}
+
+
+def write_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def export(out_dir, full=False, chunk_size=EXPORT_CHUNK):
+    """Writes the results added since the last export (all of them if full) and the games table.
+
+    Returns the number of result rows written."""
+    pa = _pyarrow()
+    results_dir = os.path.join(out_dir, 'results')
+    if full and os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(results_dir, exist_ok=True)
+    state = read_state(out_dir)
+
+    # Games deleted since the last export: drop their partitions, and export again
+    # from the largest id left after the deletion (new rows may reuse the freed ids)
+    last_id = state['results_id']
+    for deletion_id, gameid, max_id in db.query(
+            "SELECT id, gameid, max_id FROM game_deletions WHERE id > ? ORDER BY id", (state['deletion_id'],)):
+        shutil.rmtree(os.path.join(results_dir, f'gameid={gameid}'), ignore_errors=True)
+        last_id = min(last_id, max_id)
+        state['deletion_id'] = deletion_id
+
+    table_schema = results_schema(pa)
+    cursor = db.cursor(
+        f"SELECT id, {RESULTS_COLUMNS} FROM results WHERE id > ? ORDER BY id", (last_id,))
+    written = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            # file names start with the first id, so a rerun after a crash overwrites instead of duplicating
+            pa.dataset.write_dataset(_to_table(pa, rows, table_schema), results_dir, format='parquet',
+                                     partitioning=partitioning(pa),
+                                     basename_template=f'part-{rows[0][0]}-{{i}}.parquet',
+                                     existing_data_behavior='overwrite_or_ignore')
+            written += len(rows)
+            last_id = rows[-1][0]
+    finally:
+        cursor.close()
+
+    games = db.query("SELECT gameid, gamestatus, timestamp FROM games ORDER BY gameid")
+    pa.parquet.write_table(_to_table(pa, games, games_schema(pa)) if games else games_schema(pa).empty_table(),
+                           os.path.join(out_dir, 'games.parquet'))
+
+    state['results_id'] = last_id
+    write_state(out_dir, state)
+    return written
+
+
+def load_results(out_dir, gameid=None, gametype=None, columns=None):
+    """pandas DataFrame of the exported results, optionally of one game and game type"""
+    pa = _pyarrow()
+    dataset = pa.dataset.dataset(os.path.join(out_dir, 'results'), format='parquet',
+                                 partitioning=partitioning(pa))
+    condition = None
+    if gameid is not None:
+        condition = pa.dataset.field('gameid') == int(gameid)
+    if gametype is not None:
+        expr = pa.dataset.field('gametype') == gametype
+        condition = expr if condition is None else condition & expr
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+def load_games(out_dir):
+    """pandas DataFrame of the exported games table"""
+    pa = _pyarrow()
+    return pa.parquet.read_table(os.path.join(out_dir, 'games.parquet')).to_pandas()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parquet export of the game results")
+    parser.add_argument('command', choices=['export', 'load'])
+    parser.add_argument('out_dir')
+    parser.add_argument('--database', default=db.DATABASE)
+    parser.add_argument('--full', action='store_true', help="rewrite the whole export")
+    parser.add_argument('--gameid', type=int)
+    parser.add_argument('--gametype')
+    args = parser.parse_args()
+
+    db.configure(args.database)
+    schema.migrate()
+    if args.command == 'export':
+        print(f"Exported {export(args.out_dir, full=args.full)} result rows to {args.out_dir}")
+    else:
+        print(load_results(args.out_dir, args.gameid, args.gametype))
@@ -0,0 +1,159 @@
+# Micro-benchmarks of the per-request hot paths
+# Times the simulation helpers, the results rows, the Bokeh graphs and the
+# scenario generation on synthetic databases with 10, 100 and 1000 groups and
+# on valuation distributions of increasing size. Results are written as JSON
+# and compared with a stored baseline:
+#     python benchmarks/run_benchmarks.py --save-baseline    # on the reference commit
+#     python benchmarks/run_benchmarks.py                    # fails on regressions
+# Timings are the median over repeats of the mean time per call, in microseconds.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+GROUP_SIZES = [10, 100, 1000]
+DISTRIBUTION_SIZES = [1000, 100000, 1000000]
+REPEAT = 5
+MIN_TIME = 0.2      # seconds per repeat
+MIN_DIFF = 1.0      # microseconds; smaller slowdowns are noise, not regressions
+
+
+def timed(func, repeat=REPEAT, min_time=MIN_TIME):
+    """Median (over repeats) of the mean microseconds per call of func"""
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time/5 and number < 1000000:
+        number *= 10
+    return statistics.median(t/number*1e6 for t in timer.repeat(repeat, number))
+
+
+def synthetic_database(path, ngroups, rng):
+    """Database with one open game (gameid 1) where ngroups groups played every game type"""
+    import db
+    import schema
+    from results import insert_results_batch
+    import main
+
+    db.configure(path)
+    schema.migrate()
+    db.execute("INSERT INTO games (gameid, gamestatus, timestamp) VALUES (1, 'open', ?)",
+               (str(datetime.datetime.now()),))
+    submissions = []
+    for gametype in main.GAMETYPES:
+        demand = main.SCENARIOS.get(1, gametype)
+        init_inv = main.INITINV if main.HASINV[gametype] else None
+        for g in range(ngroups):
+            prices = rng.integers(100, 3000, size=main.NPERIODS).astype(float)
+            sales, ncust = demand.sales_hist(prices, init_inv)
+            end_inv = (init_inv - sales.cumsum()).tolist() if init_inv else None
+            submissions.append(main.gen_results_rows('2024-01-01 00:00:00', 1, gametype, f'group{g:04d}',
+                                                     prices.tolist(), ncust.tolist(), sales.tolist(), end_inv))
+    insert_results_batch(submissions)
+
+
+def run(quick=False):
+    import numpy as np
+    import main
+    import optimal
+    from demand import WeeklyDemand
+    from scenarios import ScenarioService
+
+    rng = np.random.default_rng(0)
+    results = {}
+    repeat = 3 if quick else REPEAT
+
+    def bench(name, func):
+        results[name] = timed(func, repeat=repeat, min_time=MIN_TIME/4 if quick else MIN_TIME)
+        print(f"{name:<48}{results[name]:>14.1f} us", flush=True)
+
+    # Simulation helpers, on the scenario of a game
+    demand = main.SCENARIOS.get(1, 'inv')
+    price_hist = '700,800,900,1000,1100,'
+    prices = main.csvstr_to_numarr(price_hist)
+    bench('csvstr_to_numarr', lambda: main.csvstr_to_numarr(price_hist))
+    bench('get_sales', lambda: main.get_sales(800.0, demand, 2))
+    bench('get_sales_hist', lambda: main.get_sales_hist(prices, main.INITINV, demand))
+    bench('gen_results_rows', lambda: main.gen_results_rows('2024-01-01 00:00:00', 1, 'inv', 'g', prices,
+                                                            [20]*5, [10]*5, [30, 20, 10, 0, 0]))
+    bench('color_gen[10]', lambda: main.color_gen(10))
+    bench('color_gen[1000]', lambda: main.color_gen(1000))
+    bench('optimal.solve[inv]', lambda: optimal.solve(demand, main.INITINV))
+
+    # Weeks with many customers
+    big_demand = WeeklyDemand([rng.integers(100, 5000, size=10000) for _ in range(main.NPERIODS)])
+    bench('get_sales[10000 customers]', lambda: main.get_sales(800.0, big_demand, 2))
+    bench('get_sales_hist[10000 customers]', lambda: main.get_sales_hist(prices, main.INITINV, big_demand))
+
+    # Scenario generation on larger valuation distributions
+    for size in DISTRIBUTION_SIZES:
+        values = np.sort(rng.integers(100, 5000000, size=size))
+        service = ScenarioService(values, {'full': (0, size), 'low': (0, size*4//5), 'high': (size*4//5, size)},
+                                  main.GAMEVALUES, (main.NUMCUST_LOW, main.NUMCUST_HIGH), main.SEED)
+        gamekeys = iter(range(10**9))
+        bench(f'scenario.generate[{size} valuations]', lambda: service.generate(next(gamekeys), 'disc'))
+
+    # Graphs, on synthetic databases
+    with main.app.test_request_context():
+        bench('draw_bokeh_graph', lambda: main.draw_bokeh_graph(price_hist, main.INITINV, demand))
+        with tempfile.TemporaryDirectory() as tmp:
+            for ngroups in (GROUP_SIZES[:2] if quick else GROUP_SIZES):
+                synthetic_database(os.path.join(tmp, f'bench{ngroups}.sqlite'), ngroups, rng)
+                bench(f'draw_results_allgroups[{ngroups} groups]', lambda: main.draw_results_allgroups(1, 'inv'))
+                bench(f'overall_standing[{ngroups} groups]', lambda: main.overall_standing(1))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Names of the benchmarks more than tolerance (fraction) slower than the baseline"""
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base:
+            change = value/base - 1
+            regression = change > tolerance and value - base > MIN_DIFF
+            print(f"{name:<48}{base:>12.1f} -> {value:>12.1f} us {change:>+8.1%} {'REGRESSION' if regression else ''}")
+            if regression:
+                regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the valuation game")
+    parser.add_argument('--output', default=os.path.join(HERE, 'latest.json'))
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown (fraction)")
+    parser.add_argument('--quick', action='store_true', help="fewer repeats, up to 100 groups")
+    args = parser.parse_args()
+
+    # main.py reads its files relative to the working directory; keep gameresults.sqlite untouched
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    os.environ['GAMEDB'] = os.path.join(tempfile.mkdtemp(prefix='bench'), 'gameresults.sqlite')
+
+    results = run(quick=args.quick)
+    output = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'unit': 'us per call',
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=1)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        if regressions:
+            sys.exit(f"{len(regressions)} benchmarks slower than the baseline: {', '.join(regressions)}")
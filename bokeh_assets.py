@@ -0,0 +1,45 @@
+# Static BokehJS resources
+# Writes the pinned BokehJS bundle to a versioned, content-hashed file under
+# static/, so pages can load it with a <script src> instead of inlining it.
+
+import hashlib
+import os
+
+BOKEH_STATIC_SUBDIR = 'bokeh'   # subdirectory of the static folder holding the bundles
+
+
+def _write_asset(folder, stem, ext, content):
+    """Write content to <stem>-<version>.<hash>.<ext> (if missing) and return the file name"""
+    from bokeh import __version__ as BOKEH_VERSION
+    data = content.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    filename = f"{stem}-{BOKEH_VERSION}.{digest}.{ext}"
+    path = os.path.join(folder, filename)
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        # Write to a temporary file first: several gunicorn workers may boot at once
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return filename
+
+
+def write_bundle(static_folder):
+    """Write the BokehJS bundle (and CSS, if any) under static_folder.
+
+    Returns a dict with the js and css file names, relative to the bokeh subdirectory."""
+    from bokeh.resources import INLINE
+    folder = os.path.join(static_folder, BOKEH_STATIC_SUBDIR)
+    assets = {'js': _write_asset(folder, 'bokeh', 'min.js', '\n'.join(INLINE.js_raw)),
+              'css': None}
+    if INLINE.css_raw:
+        assets['css'] = _write_asset(folder, 'bokeh', 'min.css', '\n'.join(INLINE.css_raw))
+    return assets
+
+
+def render_tags(js_url, css_url=None):
+    """HTML tags that load the bundle from its URL"""
+    js_resources = f'<script type="text/javascript" src="{js_url}"></script>'
+    css_resources = f'<link rel="stylesheet" href="{css_url}">' if css_url else ''
+    return js_resources, css_resources
@@ -0,0 +1,120 @@
+# Data access layer for the game database
+# Every thread of a worker process reuses one SQLite connection, opened in
+# WAL mode so that readers do not block the writer and concurrent gunicorn
+# workers only wait on each other for the (short) write transactions.
+# All queries go through the helpers below with bound parameters; sqlite3
+# keeps the prepared statements in its per-connection statement cache.
+
+import os
+import threading
+from contextlib import contextmanager
+import sqlite3 as sql
+
+import sqltrace
+from metrics import span
+
+DATABASE = 'gameresults.sqlite'   # set with configure()
+BUSY_TIMEOUT = 10.0               # seconds to wait for a lock before "database is locked"
+CACHED_STATEMENTS = 256           # prepared statements kept per connection
+
+_local = threading.local()
+
+
+def configure(database):
+    """Sets the database file used by new connections"""
+    global DATABASE
+    close()
+    DATABASE = database
+
+
+def connect(database=None):
+    """Opens a new tuned connection (in autocommit mode, see transaction())"""
+    con = sql.connect(database or DATABASE, timeout=BUSY_TIMEOUT,
+                      isolation_level=None, cached_statements=CACHED_STATEMENTS)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")    # safe with WAL, fsync only at checkpoints
+    con.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT*1000)}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    if sqltrace.ENABLED:
+        sqltrace.attach(con)
+    return con
+
+
+def get_connection():
+    """Connection of the current thread, reused across requests.
+
+    A new one is opened after a fork, so gunicorn workers never share the
+    connection of the master process."""
+    con = getattr(_local, 'con', None)
+    if con is None or _local.pid != os.getpid():
+        con = connect()
+        _local.con = con
+        _local.pid = os.getpid()
+    return con
+
+
+def close():
+    """Closes the connection of the current thread"""
+    con = getattr(_local, 'con', None)
+    if con is not None and _local.pid == os.getpid():
+        con.close()
+    _local.con = None
+
+
+@contextmanager
+def transaction():
+    """Write transaction, taking the write lock upfront (BEGIN IMMEDIATE).
+
+    Taking the lock at the start means a busy writer is waited for with the
+    busy timeout, instead of failing when a read transaction tries to upgrade."""
+    con = get_connection()
+    with span('db'), sqltrace.block(con, 'transaction'):
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con
+        except BaseException:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+        if con.in_transaction:    # pandas' to_sql commits by itself
+            con.execute("COMMIT")
+
+
+def query(statement, params=()):
+    """Rows of a SELECT statement"""
+    con = get_connection()
+    with span('db'), sqltrace.block(con, statement, params) as trace:
+        rows = con.execute(statement, params).fetchall()
+        trace['rows'] = len(rows)
+        return rows
+
+
+def query_one(statement, params=()):
+    """First row of a SELECT statement, or None"""
+    con = get_connection()
+    with span('db'), sqltrace.block(con, statement, params) as trace:
+        row = con.execute(statement, params).fetchone()
+        trace['rows'] = int(row is not None)
+        return row
+
+
+def cursor(statement, params=()):
+    """Cursor of a SELECT statement, for reading large results in chunks with fetchmany()"""
+    con = get_connection()
+    with span('db'), sqltrace.block(con, statement, params):
+        return con.execute(statement, params)
+
+
+def execute(statement, params=()):
+    """Runs a single write statement in its own transaction"""
+    with transaction() as con, sqltrace.block(con, statement, params) as trace:
+        trace['rows'] = con.execute(statement, params).rowcount
+        return trace['rows']
+
+
+def executemany(statement, seq_params):
+    """Runs a write statement for every set of parameters, in one transaction"""
+    with transaction() as con, sqltrace.block(con, statement) as trace:
+        trace['rows'] = con.executemany(statement, seq_params).rowcount
+        return trace['rows']
+
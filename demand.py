@@ -0,0 +1,51 @@
+# Demand engine for the valuation game
+# Stores the valuations of every week as sorted arrays, so that the number
+# of customers buying at a given price is found with a binary search.
+
+import numpy as np
+
+
+class WeeklyDemand:
+    """Sorted valuations for each week of one game type"""
+
+    def __init__(self, valuations):
+        # valuations: list with one list (or array) of customer valuations per week
+        self.weeks = [np.sort(np.asarray(v, dtype=float)) for v in valuations]
+        self.ncust = np.array([len(v) for v in self.weeks], dtype=int)
+        self.nperiods = len(self.weeks)
+
+    def sales(self, week, price):
+        """Units demanded in week (0-based) at the given price"""
+        vals = self.weeks[week]
+        return int(len(vals) - np.searchsorted(vals, price, side='left'))
+
+    def sales_batch(self, prices):
+        """Units demanded for an array of prices whose last axis is the week.
+
+        prices can have any leading shape, e.g. (ngroups, nweeks) or
+        (nscenarios, nweeks); the last axis may be shorter than the game."""
+        prices = np.asarray(prices, dtype=float)
+        demand = np.zeros(prices.shape, dtype=int)
+        for t in range(prices.shape[-1]):
+            vals = self.weeks[t]
+            demand[..., t] = len(vals) - np.searchsorted(vals, prices[..., t], side='left')
+        return demand
+
+    def sales_hist(self, prices, init_inv=None):
+        """Sales per week for a price path, capped by the remaining inventory.
+
+        Returns (sales, ncust) arrays with the same shape as prices."""
+        prices = np.asarray(prices, dtype=float)
+        demand = self.sales_batch(prices)
+        nweeks = prices.shape[-1]
+        ncust = np.broadcast_to(self.ncust[:nweeks], prices.shape)
+        if init_inv is None:
+            return demand, ncust
+
+        sales = np.empty_like(demand)
+        inv = np.full(prices.shape[:-1], int(init_inv), dtype=int)
+        for t in range(nweeks):
+            sales[..., t] = np.minimum(demand[..., t], inv)
+            inv = inv - sales[..., t]
+        return sales, ncust
+
@@ -0,0 +1,111 @@
+# Streamed exports of the results table
+# Rows are read from SQLite in chunks of EXPORT_CHUNK with fetchmany and
+# written out as CSV or NDJSON (optionally gzip-compressed) one chunk at a
+# time, so the memory used by an export does not depend on the size of the
+# database. The HTML view is paginated by results.id (keyset pagination).
+
+import csv
+import datetime
+import json
+import zlib
+from io import StringIO
+
+import db
+from schema import RESULTS_COLUMNS
+
+EXPORT_CHUNK = 1000       # rows read from SQLite (and written out) at a time
+PAGE_SIZE = 200           # rows per page of the HTML view
+MAX_PAGE_SIZE = 5000
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+
+def results_filter(gameid=None, gametype=None, start=None, end=None):
+    """WHERE clause and parameters for the results of a game, game type and date range.
+
+    start and end are dates (YYYY-MM-DD), both included."""
+    conditions = []
+    params = []
+    if gameid not in (None, ''):
+        conditions.append("gameid = ?")
+        params.append(int(gameid))
+    if gametype not in (None, ''):
+        conditions.append("gametype = ?")
+        params.append(gametype)
+    # timestamps are stored as text (str(datetime.datetime.now())), so dates compare as strings
+    if start not in (None, ''):
+        conditions.append("timestamp >= ?")
+        params.append(datetime.date.fromisoformat(start).isoformat())
+    if end not in (None, ''):
+        conditions.append("timestamp < ?")
+        params.append((datetime.date.fromisoformat(end) + datetime.timedelta(days=1)).isoformat())
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    return where, params
+
+
+def iter_results(where="", params=(), chunk_size=EXPORT_CHUNK):
+    """Yields lists of at most chunk_size result rows, in insertion order"""
+    cursor = db.cursor(
+        f"SELECT {RESULTS_COLUMNS} FROM results{where} ORDER BY id", params)
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def csv_chunks(chunks, columns=RESULTS_COLUMNS):
+    """CSV text of chunks of rows, with a header line"""
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(columns.split(", "))
+    yield output.getvalue()
+    for rows in chunks:
+        output.seek(0)
+        output.truncate()
+        writer.writerows(rows)
+        yield output.getvalue()
+
+
+def ndjson_chunks(chunks, columns=RESULTS_COLUMNS):
+    """Newline-delimited JSON of chunks of rows, one object per row"""
+    names = columns.split(", ")
+    for rows in chunks:
+        yield "".join(json.dumps(dict(zip(names, row))) + "\n" for row in rows)
+
+
+def gzip_chunks(chunks):
+    """gzip-compresses a stream of text chunks"""
+    compressor = zlib.compressobj(wbits=31)    # 31: gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_results(fmt='csv', compress=False, where="", params=()):
+    """(generator of chunks, mimetype, file extension) for a streamed export"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    mimetype, extension = FORMATS[fmt]
+    chunks = iter_results(where, params)
+    body = csv_chunks(chunks) if fmt == 'csv' else ndjson_chunks(chunks)
+    if compress:
+        return gzip_chunks(body), 'application/gzip', extension + '.gz'
+    return body, mimetype, extension
+
+
+def results_page(where="", params=(), after=0, page_size=PAGE_SIZE):
+    """Rows (id, results columns) of one page after the given id, and the id to continue from (None if last page)"""
+    where = where + (" AND " if where else " WHERE ") + "id > ?"
+    rows = db.query(f"SELECT id, {RESULTS_COLUMNS} FROM results{where} ORDER BY id LIMIT ?",
+                    (*params, after, page_size + 1))
+    next_after = rows[page_size - 1][0] if len(rows) > page_size else None
+    return rows[:page_size], next_after
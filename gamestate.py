@@ -0,0 +1,95 @@
+# Server-side game state for the weekly /<gametype> flow
+# Keeps the running inventory, cumulative sales and revenue of each
+# (gameid, groupid, gametype), so that every week is an O(1) update instead
+# of replaying the whole price history.
+
+import datetime
+
+import db
+
+
+def new_state(init_inv=None):
+    """State of a game before the first week"""
+    return {'week': 0, 'inv': init_inv, 'cumsales': 0, 'revenue': 0.0}
+
+
+def next_state(state, price, sales, inv):
+    """State after playing one more week"""
+    return {'week': state['week'] + 1,
+            'inv': inv,
+            'cumsales': state['cumsales'] + sales,
+            'revenue': state['revenue'] + price*sales}
+
+
+class MemoryStateStore:
+    """Game states kept in the memory of the worker process"""
+
+    def __init__(self):
+        self.states = {}
+        self.steps = {}
+
+    def start(self, key, init_inv=None):
+        """Resets the game of key and returns its initial state"""
+        self.states[key] = new_state(init_inv)
+        self.steps[key] = []
+        return self.states[key]
+
+    def get(self, key):
+        return self.states.get(key)
+
+    def record(self, key, state, price, sales, ncust, inv):
+        """Stores the result of the next week and returns the new state"""
+        state = next_state(state, price, sales, inv)
+        self.states[key] = state
+        self.steps.setdefault(key, []).append((state['week'], price, sales, ncust, inv))
+        return state
+
+    def history(self, key):
+        """List of (week, price, sales, ncust, end_inv) played so far"""
+        return list(self.steps.get(key, []))
+
+
+class SQLiteStateStore:
+    """Game states kept in the SQLite database, shared by all workers.
+
+    The game_state and game_steps tables are created by schema.migrate()."""
+
+    def start(self, key, init_inv=None):
+        state = new_state(init_inv)
+        with db.transaction() as con:
+            con.execute("DELETE FROM game_steps WHERE gameid=? AND groupid=? AND gametype=?", key)
+            self._save(con, key, state)
+        return state
+
+    def get(self, key):
+        row = db.query_one("""SELECT week, inv, cumsales, revenue FROM game_state
+                              WHERE gameid=? AND groupid=? AND gametype=?""", key)
+        if row is None:
+            return None
+        return dict(zip(('week', 'inv', 'cumsales', 'revenue'), row))
+
+    def record(self, key, state, price, sales, ncust, inv):
+        state = next_state(state, price, sales, inv)
+        with db.transaction() as con:
+            con.execute("INSERT OR REPLACE INTO game_steps VALUES (?,?,?,?,?,?,?,?)",
+                        (*key, state['week'], price, sales, ncust, inv))
+            self._save(con, key, state)
+        return state
+
+    def history(self, key):
+        return db.query("""SELECT week, price, sales, ncust, end_inv FROM game_steps
+                           WHERE gameid=? AND groupid=? AND gametype=? ORDER BY week""", key)
+
+    def _save(self, con, key, state):
+        con.execute("INSERT OR REPLACE INTO game_state VALUES (?,?,?,?,?,?,?,?)",
+                    (*key, state['week'], state['inv'], state['cumsales'], state['revenue'],
+                     str(datetime.datetime.now())))
+
+
+def make_state_store(backend):
+    """State store for the given backend ('sqlite' or 'memory')"""
+    if backend == 'memory':
+        return MemoryStateStore()
+    elif backend == 'sqlite':
+        return SQLiteStateStore()
+    raise ValueError(f"Unknown game state backend: {backend}")
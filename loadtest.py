@@ -0,0 +1,311 @@
+# Load test with a fleet of simulated groups
+# Every group plays the game like a browser does: login page, the main page
+# and weekly prices of each simulation (through the step API, the last week
+# with the form), and the submission of its results, while instructors poll
+# the dashboard (--dashboards) or follow its live stream (--streams).
+# Requests go either in-process through Flask's test client, against a
+# temporary database, or over HTTP to a running server:
+#     python loadtest.py --groups 200
+#     python loadtest.py --groups 200 --url http://127.0.0.1:8000
+# The report has the throughput and the p50/p95/p99 latency of each route,
+# the errors and the SQLite "database is locked" errors. In-process, these are
+# the exceptions raised in the app; over HTTP, only the lock errors that the
+# server reports in the response body can be counted (most routes answer a
+# generic 500 page).
+
+import argparse
+import http.client
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+GAMETYPES = ['base', 'inv', 'disc']
+NPERIODS = 5
+
+
+class TestClientTransport:
+    """Requests through the Flask test client of main.app (one client per thread)"""
+
+    def __init__(self, app):
+        from flask import got_request_exception
+        self.app = app
+        self.local = threading.local()
+        self.locked = 0     # "database is locked" exceptions raised in the app
+        self.lock = threading.Lock()
+        got_request_exception.connect(self.on_exception, app)
+
+    def on_exception(self, sender, exception, **extra):
+        if isinstance(exception, sqlite3.OperationalError) and 'locked' in str(exception):
+            with self.lock:
+                self.locked += 1
+
+    def request(self, method, path, data=None, headers=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, data=data, headers=headers or {})
+        return response.status_code, response.get_data(), dict(response.headers)
+
+    def stream(self, path, stop):
+        """Reads a server-sent events stream until it ends or stop is set: (status, events)"""
+        response = self.app.test_client().get(path, buffered=False)
+        events = 0
+        try:
+            if response.status_code == 200:
+                for chunk in response.response:
+                    events += chunk.count(b'event:' if isinstance(chunk, bytes) else 'event:')
+                    if stop.is_set():
+                        break
+        finally:
+            response.close()
+        return response.status_code, events
+
+
+class HTTPTransport:
+    """Requests over HTTP, with one keep-alive connection per thread"""
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.local = threading.local()
+
+    def request(self, method, path, data=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        for attempt in range(2):
+            con = getattr(self.local, 'con', None)
+            if con is None:
+                con = self.local.con = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                con.request(method, path, body=body, headers=headers)
+                response = con.getresponse()
+                return response.status, response.read(), dict(response.getheaders())
+            except (http.client.HTTPException, ConnectionError):
+                # the server closed the keep-alive connection: reconnect once
+                con.close()
+                self.local.con = None
+                if attempt:
+                    raise
+
+    def stream(self, path, stop):
+        """Reads a server-sent events stream until it ends or stop is set: (status, events)"""
+        con = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        events = 0
+        try:
+            con.request('GET', path)
+            response = con.getresponse()
+            if response.status == 200:
+                # the server sends a keep-alive comment every few seconds, so stop is checked often
+                while not stop.is_set():
+                    line = response.fp.readline()
+                    if not line:
+                        break
+                    events += line.startswith(b'event:')
+            return response.status, events
+        finally:
+            con.close()
+
+
+class Stats:
+    """Latencies and errors per route"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.locked = 0     # found in the response bodies, plus those counted by the transport
+        self.streams = {'opened': 0, 'rejected': 0, 'events': 0}
+        self.start = time.perf_counter()
+        self.end = None
+
+    def add(self, route, seconds, status, body):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if status >= 400 and status != 404:
+                self.errors[route] = self.errors.get(route, 0) + 1
+            if b'database is locked' in body:
+                self.locked += 1
+
+    def add_stream(self, status, events):
+        with self.lock:
+            self.streams['opened' if status == 200 else 'rejected'] += 1
+            self.streams['events'] += events
+
+    def summary(self):
+        elapsed = (self.end or time.perf_counter()) - self.start
+        routes = {}
+        for route, values in sorted(self.latencies.items()):
+            ms = np.array(values)*1000
+            routes[route] = {'requests': len(values),
+                             'errors': self.errors.get(route, 0),
+                             'throughput': len(values)/elapsed,
+                             'p50_ms': float(np.percentile(ms, 50)),
+                             'p95_ms': float(np.percentile(ms, 95)),
+                             'p99_ms': float(np.percentile(ms, 99)),
+                             'max_ms': float(ms.max())}
+        total = sum(len(v) for v in self.latencies.values())
+        return {'elapsed_s': elapsed,
+                'requests': total,
+                'throughput': total/elapsed if elapsed else 0.0,
+                'errors': sum(self.errors.values()),
+                'locked_errors': self.locked,
+                'streams': dict(self.streams),
+                'routes': routes}
+
+
+def report(summary):
+    """Text table of a summary"""
+    lines = [f"{summary['requests']} requests in {summary['elapsed_s']:.1f} s "
+             f"({summary['throughput']:.1f} req/s), {summary['errors']} errors, "
+             f"{summary['locked_errors']} 'database is locked' errors",
+             f"{'route':<16}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"]
+    for route, r in summary['routes'].items():
+        lines.append(f"{route:<16}{r['requests']:>9}{r['errors']:>8}{r['throughput']:>9.1f}"
+                     f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['max_ms']:>9.1f}")
+    streams = summary['streams']
+    if streams['opened'] or streams['rejected']:
+        lines.append(f"live dashboards: {streams['opened']} streams opened, {streams['rejected']} rejected "
+                     f"(polling instead), {streams['events']} update events")
+    return "\n".join(lines)
+
+
+class LoadTest:
+    def __init__(self, transport, gameid, think=0.0, prices=(100, 3000), seed=None):
+        self.transport = transport
+        self.gameid = gameid
+        self.think = think          # seconds between the requests of a group
+        self.prices = prices        # range of the random prices
+        self.seed = seed
+        self.stats = Stats()
+        self.done = threading.Event()
+
+    def call(self, route, method, path, data=None, headers=None):
+        start = time.perf_counter()
+        try:
+            status, body, response_headers = self.transport.request(method, path, data, headers)
+        except Exception as e:
+            status, body, response_headers = 599, str(e).encode(), {}
+        self.stats.add(route, time.perf_counter() - start, status, body)
+        if self.think:
+            time.sleep(self.think)
+        return status, body, response_headers
+
+    def create_game(self):
+        self.call('dashboard', 'POST', '/dashboard', {'gameid': self.gameid, 'gametype': 'base', 'isnew': 1})
+
+    def delete_game(self):
+        self.transport.request('POST', '/manage_games', {'gameid': self.gameid, 'delete': 1})
+
+    def play(self, group):
+        """Flow of one group: all the simulations, each one submitted at the end"""
+        rng = random.Random(f"{self.seed}-{group}")
+        groupname = f"load{group:04d}"
+        form = {'gameid': self.gameid, 'groupname': groupname}
+        self.call('login', 'GET', '/login')
+        for gametype in GAMETYPES:
+            self.call('maingame', 'POST', '/maingame', dict(form, gametype=gametype))
+            self.call('gametype', 'POST', f'/{gametype}', form)
+            price_hist = ''
+            for stage in range(1, NPERIODS + 1):
+                price = rng.randint(*self.prices)
+                week = dict(form, price=price, stage=stage, price_hist=price_hist)
+                if stage < NPERIODS:
+                    self.call('api_step', 'POST', f'/api/step/{gametype}', week)
+                else:
+                    self.call('gametype', 'POST', f'/{gametype}', week)
+                price_hist += f'{price},'
+            self.call('results', 'POST', f'/results/{gametype}', dict(form, price_hist=price_hist))
+
+    def poll_dashboard(self, interval):
+        """Instructor refreshing the dashboard of each simulation, with the ETag of the last response"""
+        etags = {}
+        while not self.done.is_set():
+            for gametype in GAMETYPES:
+                headers = {'If-None-Match': etags[gametype]} if gametype in etags else {}
+                status, _, response_headers = self.call(
+                    'dashboard', 'GET', f'/dashboard?gameid={self.gameid}&gametype={gametype}', headers=headers)
+                etag = response_headers.get('ETag')
+                if status == 200 and etag:
+                    etags[gametype] = etag
+                if self.done.wait(interval):
+                    break
+
+    def watch_stream(self, retry):
+        """Instructor following the live dashboard; a rejected stream is retried after retry seconds"""
+        path = f'/dashboard/stream?gameid={self.gameid}'
+        while not self.done.is_set():
+            try:
+                status, events = self.transport.stream(path, self.done)
+            except Exception:
+                status, events = 599, 0
+            self.stats.add_stream(status, events)
+            if status != 200:
+                self.done.wait(retry)
+
+    def run(self, groups, concurrency=None, dashboards=1, poll_interval=2.0, streams=0):
+        self.create_game()
+        self.stats = Stats()
+        locked = getattr(self.transport, 'locked', 0)
+        pollers = [threading.Thread(target=self.poll_dashboard, args=(poll_interval,), daemon=True)
+                   for _ in range(dashboards)]
+        pollers += [threading.Thread(target=self.watch_stream, args=(poll_interval,), daemon=True)
+                    for _ in range(streams)]
+        for t in pollers:
+            t.start()
+        with ThreadPoolExecutor(max_workers=concurrency or groups) as pool:
+            list(pool.map(self.play, range(groups)))
+        self.stats.end = time.perf_counter()
+        self.done.set()
+        for t in pollers:
+            t.join()
+        self.stats.locked += getattr(self.transport, 'locked', 0) - locked
+        return self.stats.summary()
+
+
+def in_process_transport():
+    """Test client of the app, on a new temporary database (GAMEDB)"""
+    os.environ['GAMEDB'] = os.path.join(tempfile.mkdtemp(prefix='loadtest'), 'gameresults.sqlite')
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))    # valuations.txt, templates and static
+    import main
+    return TestClientTransport(main.app)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test with simulated groups")
+    parser.add_argument('--groups', type=int, default=50, help="number of simulated groups")
+    parser.add_argument('--concurrency', type=int, help="groups playing at the same time (default: all)")
+    parser.add_argument('--url', help="base URL of a running server (default: in-process test client)")
+    parser.add_argument('--gameid', type=int, default=random.randint(900000, 999999))
+    parser.add_argument('--dashboards', type=int, default=1, help="instructors polling the dashboard")
+    parser.add_argument('--streams', type=int, default=0, help="instructors following the live dashboard")
+    parser.add_argument('--poll', type=float, default=2.0, help="seconds between dashboard refreshes")
+    parser.add_argument('--think', type=float, default=0.0, help="seconds between the requests of a group")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help="keep the load test game (HTTP mode)")
+    parser.add_argument('--json', help="write the summary to this file")
+    args = parser.parse_args()
+
+    transport = HTTPTransport(args.url) if args.url else in_process_transport()
+    test = LoadTest(transport, args.gameid, think=args.think, seed=args.seed)
+    summary = test.run(args.groups, args.concurrency, args.dashboards, args.poll, args.streams)
+    if args.url and not args.keep:
+        test.delete_game()
+    print(report(summary))
+    if args.url:
+        print("Over HTTP, only the lock errors reported in the response bodies are counted")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(summary, groups=args.groups, url=args.url), f, indent=1)
+    sys.exit(1 if summary['errors'] or summary['locked_errors'] else 0)
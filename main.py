@@ -4,38 +4,106 @@
 # By Marcelo Olivares
 # First version: 10/04/2021
 
-from io import StringIO
+import startup    # first, so that the startup report includes the imports
+
 import random
-import base64
 import numpy as np
-import pandas as pd
-import sqlite3 as sql
 import datetime
 import itertools
-import csv
+import os
+import functools
+import hashlib
+import json
+import time
+import threading
+
+import db
+import schema
+import valuedist
+import sqltrace
+import optimal
+from montecarlo import MonteCarlo
+from schema import RESULTS_COLUMNS
+from scenarios import ScenarioService, game_key
+from gamestate import make_state_store
+from results import (save_results, enable_write_behind, replay_spilled, flush_pending, get_standings,
+                     delete_game, get_last_result_id, get_new_results, get_group_standings, get_results_version)
+from lrucache import LRUCache
+from opengames import OpenGames
+from exports import results_filter, export_results, results_page, PAGE_SIZE, MAX_PAGE_SIZE
+from bokeh_assets import BOKEH_STATIC_SUBDIR, write_bundle, render_tags
 
 #from io import BytesIO
 
 from flask import Flask, render_template, request, redirect, url_for
-from flask import request, make_response
-from matplotlib.figure import Figure
+from flask import request, make_response, send_from_directory, jsonify, Response, stream_with_context
+import metrics
+
+# time spent in Jinja is reported as the 'render' phase of the request (see metrics.py)
+render_template = metrics.timed('render')(render_template)
 
-from bokeh.embed import components
-from bokeh.plotting import figure
-from bokeh.resources import INLINE
-from bokeh.models import ColumnDataSource, Range1d, Legend, HoverTool,CustomJS, CheckboxGroup
-from bokeh.core.properties import value
-from bokeh.layouts import column, row
-from bokeh.palettes import Category10, Category20, inferno
+# matplotlib, pandas and bokeh are imported by the functions that use them,
+# so that a worker boots without loading them (see startup.py)
 
 
 
 
 
 app = Flask(__name__)
+startup.checkpoint('imports')
+
+# Valuation distribution: a text file with one valuation per line, or a .npy file made with valuedist.py
+FILEVALUATIONS = os.environ.get('VALUATIONS_FILE', "valuations.txt")
+DATABASE = os.environ.get('GAMEDB', 'gameresults.sqlite') # Database file to store results
+
+# BokehJS resources: 'static' serves a cached bundle from static/bokeh, 'inline' embeds it in every page
+BOKEH_RESOURCES = os.environ.get('BOKEH_RESOURCES', 'static')
+BOKEH_CACHE_MAX_AGE = 365*24*3600   # bundle file names are content-hashed, so they can be cached for long
+
+# Write-behind queue for submitted results: group commits on a background thread
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', '0.2'))  # seconds
+WRITE_BEHIND_BATCH = int(os.environ.get('WRITE_BEHIND_BATCH', '200'))           # submissions per commit
+# Batches that could not be written are kept here and inserted at the next startup
+WRITE_BEHIND_SPILL = os.environ.get('WRITE_BEHIND_SPILL',
+                                    os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'writebehind'))
+
+# Live dashboard updates (server-sent events)
+SSE_POLL_INTERVAL = 0.5     # seconds between checks for new results
+SSE_MAX_DURATION = 300      # seconds before the stream is closed (the browser reconnects)
+SSE_KEEPALIVE = 5           # seconds between keep-alive comments (a closed tab is noticed at the next one)
+# Streams open at once in each worker: each one holds a thread, which the groups' requests need more.
+# Dashboards beyond that poll the page with its ETag instead (every SSE_FALLBACK_POLL seconds).
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', '2'))
+SSE_FALLBACK_POLL = 10
+
+# Groups shown in the legend of the price history graph (larger classes use only the checkbox list)
+LEGEND_MAX_GROUPS = 20
+
+# Rendered dashboard graphs, keyed by (gameid, gametype, results version)
+DASHBOARD_CACHE_SIZE = 64
+
+# Build the Bokeh bundle and main game graphs at startup (with gunicorn --preload, once in the master)
+PRELOAD_BOKEH = os.environ.get('PRELOAD_BOKEH', '0') == '1'
+
+# Print the time of each startup step
+STARTUP_REPORT = os.environ.get('STARTUP_REPORT', '0') == '1'
+
+# Request metrics (/metrics): directory where the gunicorn workers share their histograms
+# (next to the database by default; an empty METRICS_DIR keeps them per worker)
+METRICS_DIR = os.environ.get('METRICS_DIR',
+                             os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'metrics'))
 
-FILEVALUATIONS = "valuations.txt"
-DATABASE = 'gameresults.sqlite' # Database file to store results
+# SQL tracing (see sqltrace.py): statements slower than SQL_SLOW_MS are logged with their query plan
+SQL_TRACE = os.environ.get('SQL_TRACE', '0') == '1'
+SQL_SLOW_MS = float(os.environ.get('SQL_SLOW_MS', '100'))
+SQL_TRACE_LOG = os.environ.get('SQL_TRACE_LOG')     # log of every statement (default: slow ones to stderr)
+
+# Open games registry: seconds between checks of the games version in each worker
+OPEN_GAMES_TTL = 2.0
+
+# Storage of the weekly game state: 'sqlite' is shared by all workers, 'memory' is per process
+GAMESTATE_BACKEND = os.environ.get('GAMESTATE_BACKEND', 'sqlite')
 
 NPERIODS = 5                # Number of weeks in simulation
 NPERIODS_HIGH = 1           # Number of weeks with high valuation in price discrimination setting
@@ -57,7 +125,10 @@ GAMENAMES = {'base': 'No inventory',
 HIGHVALUE_CUT = 0.2
 NUMCUST_LOW = 10
 NUMCUST_HIGH = 20
-SEED = 1975
+SEED = 1975                 # with the game id and game type, seeds the scenario of each game
+SCENARIO_CACHE_SIZE = 1024  # scenarios kept in memory, per worker
+MC_SCENARIOS = 10000        # default number of random scenarios of /api/evaluate
+MC_MAX_SCENARIOS = 100000
 
 # Header for the game types
 GAMEHEADER = {
@@ -76,44 +147,51 @@ GAMEHEADER = {
 # ----------------------------------------------
 
 #----------- GENERATE VALUATIONS FOR EACH GAME TYPE -------------------
-valfile = open(FILEVALUATIONS)
-val_list = valfile.readlines()
-
-valdist = list(map(int, val_list))  # map() applies function int() to each item in val_list
-valdist.sort()
-numobs = len(valdist)
-numcut = int(np.floor(numobs*(1-HIGHVALUE_CUT)))
-
-VALUEDIST = {}
-VALUEDIST['full'] = valdist
-VALUEDIST['high'] = valdist[numcut:(numobs-1)]
-VALUEDIST['low'] = valdist[0:numcut]
-
-VALUATIONS = {}
-random.seed(SEED)
-
-for g in GAMETYPES:
-    valuations = []
-    for n in range(NPERIODS):
-        valtype = GAMEVALUES[g][n]
-        ncust = random.randint(NUMCUST_LOW,NUMCUST_HIGH)
-        valuations.append(random.choices(VALUEDIST[valtype], k = ncust))
-    VALUATIONS[g] = valuations
-
-
-# CREATE TABLES IF THEY DON'T EXIST
-
-con = sql.connect(DATABASE)
-cur = con.cursor()
-#
-# # Create results table
-cur.execute("""CREATE TABLE IF NOT EXISTS results
-                 (timestamp text, gameid text, gametype text, groupid text,
-                  period integer, price real, ncust integer, sales integer, end_inv integer)""")
-cur.execute("""CREATE TABLE IF NOT EXISTS games 
-                (gameid integer, gamestatus text, timestamp text)""")
-con.commit()
-con.close()
+valdist = valuedist.load(FILEVALUATIONS)
+
+# Range of the sorted valuations for each valuation type
+VALUEDIST = valdist.ranges(HIGHVALUE_CUT)
+startup.checkpoint('valuations')
+
+# Customers and valuations of each game are drawn on first use (see scenarios.py)
+SCENARIOS = ScenarioService(valdist.values, VALUEDIST, GAMEVALUES, (NUMCUST_LOW, NUMCUST_HIGH), SEED,
+                            cache_size=SCENARIO_CACHE_SIZE)
+startup.checkpoint('scenarios')
+
+
+# CREATE OR UPGRADE TABLES (see schema.py)
+
+sqltrace.configure(SQL_TRACE, SQL_SLOW_MS, SQL_TRACE_LOG)
+db.configure(DATABASE)
+applied = schema.migrate()
+if applied:
+    print(f"Database upgraded to schema version {schema.SCHEMA_VERSION}: {', '.join(applied)}")
+# Each thread (and forked worker) opens its own connection on first use
+db.close()
+startup.checkpoint('database')
+
+# Threads of this worker that may hold a dashboard stream
+SSE_SLOTS = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+# Open game ids of this worker, kept in sync through the games version (see opengames.py)
+OPEN_GAMES = OpenGames(OPEN_GAMES_TTL)
+
+if WRITE_BEHIND:
+    enable_write_behind(WRITE_BEHIND_INTERVAL, WRITE_BEHIND_BATCH, WRITE_BEHIND_SPILL)
+# submissions accepted before a failed write (even if write-behind has been turned off since)
+replayed = replay_spilled(WRITE_BEHIND_SPILL)
+if replayed:
+    print(f"Wrote {replayed} write-behind submissions kept in {WRITE_BEHIND_SPILL}")
+
+# Cache of rendered dashboard graphs
+DASHBOARD_CACHE = LRUCache(DASHBOARD_CACHE_SIZE)
+
+# Game state of the weekly /<gametype> flow
+GAMESTATE = make_state_store(GAMESTATE_BACKEND)
+
+# Latency histograms per route and phase
+metrics.init_app(app, METRICS_DIR)
+startup.checkpoint('game state')
 
 
 # ------------ APP FUNCTIONS -------------------------
@@ -124,41 +202,63 @@ def login():
     return render_template('login.html')
 
 
+@app.route('/admin/sql_trace', methods=['GET', 'POST'])
+def sql_trace():
+    """Statements run by this worker (with SQL_TRACE=1): totals, slow ones with their plans, latest ones"""
+    if request.method == 'POST' and 'reset' in request.form:
+        sqltrace.reset()
+        return redirect(url_for('sql_trace'))
+    return render_template('sql_trace.html', trace=sqltrace.snapshot(), pid=os.getpid())
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Latency histograms per route and phase, of all the workers, in Prometheus text format"""
+    return Response(metrics.render(metrics.collect()), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/bokeh-static/<path:filename>')
+def bokeh_static(filename):
+    """Serves the content-hashed BokehJS bundle with long-lived cache headers"""
+    response = send_from_directory(os.path.join(app.static_folder, BOKEH_STATIC_SUBDIR), filename,
+                                   max_age=BOKEH_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 
 
 # -------------- AUXILIARY FUNCTIONS ------------------------
 
-def get_sales(pricenum,values):
-    """Calculate sales for the submitted (numeric) price"""
-    sales = 0
-    for i in range(len(values)):
-        sales = sales + (values[i]>=pricenum)
-    return str(sales)
+def get_sales(pricenum, demand, week):
+    """Calculate sales for the submitted (numeric) price in a given week (0-based)"""
+    return str(demand.sales(week, pricenum))
 
-def get_sales_hist(price_list,init_inv,valuations):
+def get_sales_hist(price_list, init_inv, demand):
+    """Sales and number of customers for each week of a price history"""
     if init_inv:
-        invnum = int(init_inv)
+        init_inv = int(init_inv)
     else:
-        invnum = float("inf")
+        init_inv = None
+    return demand.sales_hist(price_list, init_inv)
 
-    tperiod = len(price_list)
-    sales_list = []
-    ncust_list = []
-    for t in range(tperiod):
-        salesnum = min( int(get_sales(price_list[t],valuations[t])), invnum)
+def play_week(demand, week, pricenum, invnum=None):
+    """Sales, number of customers and ending inventory for one week (0-based)"""
+    salesnum = demand.sales(week, pricenum)
+    if invnum is not None:
+        salesnum = min(salesnum, invnum)
         invnum = invnum - salesnum
-        sales_list.append(salesnum)
-        ncust_list.append(len(valuations[t]))
-    sales_arr = np.array(sales_list)
-    ncust_arr = np.array(ncust_list)
-    return sales_arr, ncust_arr
+    return salesnum, int(demand.ncust[week]), invnum
 
 def csvstr_to_numarr(csv_str):
     if csv_str:
-        return list(map(float, csv_str.split(',')))
+        # price_hist is built with a trailing comma, skip empty fields
+        return [float(x) for x in csv_str.split(',') if x]
     return []
 
-def draw_graph(price_hist, init_inv,valuations):
+def draw_graph(price_hist, init_inv, demand):
+    from matplotlib.figure import Figure
     global NPERIODS
     XMAX = NPERIODS +2  # length of the x-axis, extended to put label
     price_list= csvstr_to_numarr(price_hist)
@@ -175,7 +275,7 @@ def draw_graph(price_hist, init_inv,valuations):
     ax.plot(x, price_list)
     ax.scatter(x, price_list)
 
-    (sales_arr,ncust_arr) = get_sales_hist(price_list, init_inv,valuations)
+    (sales_arr,ncust_arr) = get_sales_hist(price_list, init_inv, demand)
     lostsales_arr = ncust_arr - sales_arr
     ax2 = fig.add_subplot(212)
     ax2.bar(x, sales_arr, label='Sales')
@@ -191,27 +291,34 @@ def draw_graph(price_hist, init_inv,valuations):
 
     return fig
 
-from bokeh.models import ColumnDataSource, CustomJS, HoverTool
-from bokeh.plotting import figure
-from bokeh.embed import components
-from bokeh.resources import INLINE
-
-
-
-def draw_bokeh_graph(price_hist, init_inv, valuations):
+@metrics.timed('figure')
+def draw_bokeh_graph(price_hist, init_inv, demand, steps=None):
+    """Price and sales graphs of the weeks played so far.
 
+    steps is the list of (week, price, sales, ncust, end_inv) stored in the game
+    state; without it, sales are recomputed from price_hist."""
+    from bokeh.models import ColumnDataSource, HoverTool
+    from bokeh.plotting import figure
+    from bokeh.layouts import column
     global NPERIODS
     XMAX = NPERIODS + 2  # length of the x-axis, extended to put label
-    price_list = csvstr_to_numarr(price_hist)
-    price_arr = np.array(price_list)
+    if steps is None:
+        price_list = csvstr_to_numarr(price_hist)
+        (sales_arr, ncust_arr) = get_sales_hist(price_list, init_inv, demand)
+    else:
+        price_list = [s[1] for s in steps]
+        sales_arr = np.array([s[2] for s in steps], dtype=int)
+        ncust_arr = np.array([s[3] for s in steps], dtype=int)
     x = list(map(str,range(1, len(price_list) + 1)))
     weeks = list(map(str,range(1,NPERIODS+1)))
 
     # Graph 1: price history
+    # Sources are named so that the page can append new weeks (see step_api)
+    price_source = ColumnDataSource(data=dict(x=x, y=price_list), name="price_data_source")
     g = figure( height=250, x_range= weeks,
                 toolbar_location=None, title="Price history")
-    price_line = g.line(x,price_arr, line_width=2)
-    price_circ = g.circle(x,price_arr, fill_color='white', size=8)
+    price_line = g.line('x', 'y', source=price_source, line_width=2)
+    price_circ = g.circle('x', 'y', source=price_source, fill_color='white', size=8)
 
     # add hover
     hover1 = HoverTool(tooltips=[('Price', '@y')],
@@ -225,19 +332,18 @@ def draw_bokeh_graph(price_hist, init_inv, valuations):
     g.xgrid.grid_line_color = None
 
     # Figure 2: bar graph of sales and lost sales
-    (sales_arr, ncust_arr) = get_sales_hist(price_list, init_inv, valuations)
     lostsales_arr = ncust_arr - sales_arr
 
     colstack = ['sales','no purchase']
     data = {'week':x,
-            'sales': sales_arr,
-            'no purchase':lostsales_arr,
-            'customers': ncust_arr,
-            'fraction':sales_arr/ncust_arr}
+            'sales': sales_arr.tolist(),
+            'no purchase':lostsales_arr.tolist(),
+            'customers': ncust_arr.tolist(),
+            'fraction':(sales_arr/ncust_arr).tolist()}
 
     colors = ["#718dbf", "#e84d60"]
 
-    source = ColumnDataSource(data=data)
+    source = ColumnDataSource(data=data, name="bar_data_source")
 
     p = figure( height=250, x_range= weeks,
                 toolbar_location=None, title="Number of customers and sales per week")
@@ -259,10 +365,78 @@ def draw_bokeh_graph(price_hist, init_inv, valuations):
 
     return column(g,p)
 
+def render_components(obj):
+    """Script and div(s) of Bokeh models (bokeh.embed.components)"""
+    from bokeh.embed import components
+    with metrics.span('components'):
+        return components(obj)
+
+@functools.lru_cache(maxsize=None)
+def get_bokeh_assets():
+    """File names of the BokehJS bundle, written to the static folder on first use"""
+    return write_bundle(app.static_folder)
+
+@functools.lru_cache(maxsize=1)
+def inline_bokeh_resources():
+    """BokehJS inlined in the page (several MB), rendered once per worker"""
+    from bokeh.resources import INLINE
+    return INLINE.render_js(), INLINE.render_css()
+
+def bokeh_resources():
+    """JS and CSS resources for BokehJS, according to BOKEH_RESOURCES"""
+    if BOKEH_RESOURCES == 'inline':
+        with metrics.span('bokeh_resources'):
+            return inline_bokeh_resources()
+    with metrics.span('bokeh_resources'):
+        assets = get_bokeh_assets()
+    js_url = url_for('bokeh_static', filename=assets['js'])
+    css_url = url_for('bokeh_static', filename=assets['css']) if assets['css'] else None
+    return render_tags(js_url, css_url)
+
+def bokeh_resources_version():
+    """Identifies the BokehJS resources of the pages, for their ETags"""
+    if BOKEH_RESOURCES == 'inline':
+        from bokeh import __version__
+        return ('inline', __version__)
+    assets = get_bokeh_assets()
+    return ('static', assets['js'], assets['css'])
+
+@functools.lru_cache(maxsize=SCENARIO_CACHE_SIZE)
+def get_optimal(gameid, gametype):
+    """Clairvoyant optimal policy of the scenario of a game (see optimal.py)"""
+    init_inv = INITINV if HASINV[gametype] else None
+    return optimal.solve(SCENARIOS.get(gameid, gametype), init_inv)
+
+def get_gap(gameid, gametype, revenue):
+    """Optimality gap (%) of a revenue, or None for an unknown game type"""
+    if gametype not in GAMETYPES:
+        return None
+    return optimal.optimality_gap(revenue, get_optimal(gameid, gametype).revenue)
+
+def get_valuations(gameid, gametype):
+    """Customer valuations of each week of a game, as lists for the page"""
+    return [[int(v) for v in week] for week in SCENARIOS.get(gameid, gametype).weeks]
+
+def load_game_state(key, gametype, stagenum, price_hist):
+    """Game state before playing week stagenum (1-based).
+
+    If the store has no matching state (new worker with the memory backend,
+    page reloaded, ...), it is rebuilt from the price history of the form;
+    with fewer than stagenum-1 prices, the state is of an earlier week."""
+    state = GAMESTATE.get(key)
+    if state is not None and state['week'] == stagenum - 1:
+        return state
+
+    init_inv = INITINV if HASINV[gametype] else None
+    state = GAMESTATE.start(key, init_inv)
+    for t, pricenum in enumerate(csvstr_to_numarr(price_hist)[:stagenum-1]):
+        salesnum, ncust, invnum = play_week(SCENARIOS.get(key[0], gametype), t, pricenum, state['inv'])
+        state = GAMESTATE.record(key, state, pricenum, salesnum, ncust, invnum)
+    return state
+
 def get_active_games():
-    with  sql.connect(DATABASE) as con:
-        df = pd.read_sql("""SELECT * FROM games WHERE gamestatus='open'""", con=con)
-    return list(df['gameid'])
+    """Sorted ids of the open games"""
+    return OPEN_GAMES.list()
 
 #----------------------------
 
@@ -271,37 +445,18 @@ def get_active_games():
 
 #### ----------------- NEW CODE ----------------------------
 
-from bokeh.resources import INLINE
-
-from flask import Flask, render_template
-from bokeh.plotting import figure
-from bokeh.embed import components
-from bokeh.models import ColumnDataSource
-from bokeh.resources import INLINE
-
-@app.route('/maingame', methods=['POST'])
-def maingame():
-    # Get parameters from POST request
-    gameid = request.form.get("gameid")
-    groupname = request.form.get("groupname")
-    gametype = request.form.get("gametype", "base")  # Default to "base" if not provided
-    # Get the game header for the selected game type
-    game_header = GAMEHEADER.get(gametype, "")
-
-    # Set initial inventory if game type requires it
-    if HASINV[gametype]:
-        init_inv = INITINV
-    else:
-        init_inv = None
-
-    hasinv = 1 if init_inv is not None else 0
-
-    # Fetch the valuation types for the current game type
-    valuetype_array = GAMEVALUES[gametype]
+@functools.lru_cache(maxsize=None)
+@metrics.timed('figure')
+def maingame_components(gametype, nperiods, init_inv, bokeh_version):
+    """Script and div of the (empty) price and sales graphs of the main game page.
 
+    The graphs are filled on the client side, so the output only depends on the
+    game configuration, which is part of the cache key."""
+    from bokeh.models import ColumnDataSource, HoverTool
+    from bokeh.plotting import figure
     # Initialize Bokeh sources as before
-    price_list = [None] * 5
-    x_values = [str(i) for i in range(1, 6)]
+    price_list = [None] * nperiods
+    x_values = [str(i) for i in range(1, nperiods + 1)]
     price_source = ColumnDataSource(data=dict(x=x_values, y=price_list), name="price_data_source")
 
     # Create Bokeh plots (similar to previous code)
@@ -319,10 +474,10 @@ def maingame():
 
     bar_data = {
         'week': x_values,
-        'sales': [0] * 5,
-        'no_purchase': [0] * 5,
-        'customers': [0] * 5,
-        'fraction': [0] * 5,
+        'sales': [0] * nperiods,
+        'no_purchase': [0] * nperiods,
+        'customers': [0] * nperiods,
+        'fraction': [0] * nperiods,
     }
     bar_source = ColumnDataSource(data=bar_data, name="bar_data_source")
 
@@ -343,17 +498,50 @@ def maingame():
     p_bar.legend.location = "top_right"
     p_bar.legend.orientation = "horizontal"
 
-    script, divs = components((p_price, p_bar))
-    js_resources = INLINE.render_js()
-    css_resources = INLINE.render_css()
+    script, divs = render_components((p_price, p_bar))
+    return script, divs[0] + divs[1]
+
+def get_maingame_components(gametype):
+    """Cached Bokeh components of the main game page for the current game configuration"""
+    from bokeh import __version__ as bokeh_version
+    init_inv = INITINV if HASINV[gametype] else None
+    return maingame_components(gametype, NPERIODS, init_inv, bokeh_version)
+
+def clear_component_cache():
+    """Invalidate cached Bokeh components, e.g. after changing the game configuration"""
+    maingame_components.cache_clear()
+
+
+@app.route('/maingame', methods=['POST'])
+def maingame():
+    # Get parameters from POST request
+    gameid = request.form.get("gameid")
+    groupname = request.form.get("groupname")
+    gametype = request.form.get("gametype", "base")  # Default to "base" if not provided
+    # Get the game header for the selected game type
+    game_header = GAMEHEADER.get(gametype, "")
+
+    # Set initial inventory if game type requires it
+    if HASINV[gametype]:
+        init_inv = INITINV
+    else:
+        init_inv = None
+
+    hasinv = 1 if init_inv is not None else 0
+
+    # Fetch the valuation types for the current game type
+    valuetype_array = GAMEVALUES[gametype]
+
+    script, div = get_maingame_components(gametype)
+    js_resources, css_resources = bokeh_resources()
 
     return render_template(
         'maingame.html',
         plot_script=script,
-        plot_div=divs[0] + divs[1],
+        plot_div=div,
         js_resources=js_resources,
         css_resources=css_resources,
-        valuations=VALUATIONS[gametype],  # Assume valuations set elsewhere
+        valuations=get_valuations(gameid, gametype),
         init_inv=init_inv if hasinv else None,
         hasinv=hasinv,
         gameid=gameid,
@@ -369,15 +557,13 @@ def maingame():
 
 @app.route("/results/<string:gametype>", methods=['POST'])
 def send_results(gametype):
-    global VALUATIONS, GAMETYPES, HASINV
+    global GAMETYPES, HASINV
 
-    valuations = VALUATIONS[gametype]
     if not gametype in GAMETYPES:
         return "<h2> URL not found </h2>"
-    elif HASINV[gametype]:
-        init_inv = INITINV
-    else:
-        init_inv = None
+
+    gameid = request.form.get("gameid")
+    groupname = request.form.get("groupname")
 
     # Retrieve form data
     price_hist_str = request.form.get("price_hist")
@@ -385,37 +571,37 @@ def send_results(gametype):
     sales_str = request.form.get("sales")
     end_inv_str = request.form.get("end_inv")
 
-    # Convert to lists
-    price_hist = list(map(float, price_hist_str.split(','))) if price_hist_str else []
-    ncust = list(map(int, ncust_str.split(','))) if ncust_str else []
-    sales = list(map(int, sales_str.split(','))) if sales_str else []
-    end_inv = [int(x) if x else None for x in end_inv_str.split(',')] if end_inv_str else [None] * len(price_hist)
-
-    # Ensure lengths match
-    min_length = min(len(price_hist), len(ncust), len(sales), len(end_inv))
-    price_hist = price_hist[:min_length]
-    ncust = ncust[:min_length]
-    sales = sales[:min_length]
-    end_inv = end_inv[:min_length]
-
-    # Generate results table
-    currtime = datetime.datetime.now()
-    df = gen_results_table(
-        timestamp=str(currtime), 
-        gameid=request.form.get("gameid"), 
-        gametype=gametype, 
-        groupid=request.form.get("groupname"),
-        price_hist=price_hist, 
-        ncust=ncust, 
-        sales=sales, 
-        end_inv=end_inv
-    )
+    try:
+        # Convert to lists
+        price_hist = csvstr_to_numarr(price_hist_str)
+        if price_hist and not sales_str:
+            # Legacy /<gametype> flow only sends the prices: weeks are in the game state,
+            # rebuilt from the prices if this worker does not have them (memory backend)
+            if len(price_hist) > NPERIODS:
+                raise ValueError(f"Results must have between 1 and {NPERIODS} weeks.")
+            key = (int(gameid), groupname, gametype)
+            load_game_state(key, gametype, len(price_hist) + 1, price_hist_str)
+            steps = GAMESTATE.history(key)
+            price_hist = [s[1] for s in steps]
+            ncust = [s[3] for s in steps]
+            sales = [s[2] for s in steps]
+            end_inv = [s[4] for s in steps]
+        else:
+            ncust = list(map(int, ncust_str.split(','))) if ncust_str else []
+            sales = list(map(int, sales_str.split(','))) if sales_str else []
+            end_inv = [int(x) if x else None for x in end_inv_str.split(',')] if end_inv_str else None
 
-    # Save the DataFrame to the database
+        # Generate results rows
+        currtime = datetime.datetime.now()
+        rows = gen_results_rows(timestamp=str(currtime), gameid=int(gameid), gametype=gametype,
+                                groupid=groupname, price_hist=price_hist,
+                                ncust=ncust, sales=sales, end_inv=end_inv)
+    except (TypeError, ValueError) as e:
+        return f"<h1> Error: invalid results</h1>{e}"
+
+    # Save the rows to the database
     try:
-        with sql.connect(DATABASE) as con:
-            df.to_sql('results', con=con, if_exists='append', index=False)
-            con.commit()
+        save_results(rows)
         saved = True
     except Exception as e:
         saved = False
@@ -426,53 +612,30 @@ def send_results(gametype):
         currgame_index = GAMETYPES.index(gametype)
         nextgame = GAMETYPES[currgame_index + 1] if currgame_index < len(GAMETYPES) - 1 else None
         
-        return render_template("result_confirm.html", tables=[df.to_html(classes='data', header="true")], nextgame=nextgame, gameid=request.form.get("gameid"), groupname=request.form.get("groupname"))
+        return render_template("result_confirm.html", columns=RESULTS_COLUMNS.split(', '), rows=rows,
+                               nextgame=nextgame, gameid=gameid, groupname=groupname)
     else:
         return f"<h1> Error: results could not be saved</h1>{error_msg}"
 
-def gen_results_table(timestamp, gameid, gametype, groupid, price_hist, ncust, sales, end_inv=None):
-    """Calculates results table from price_hist and other lists"""
-
-    # Convert price_hist from a CSV string to a list of floats if it’s not already a list
-    if isinstance(price_hist, str):
-        price = list(map(float, price_hist.split(',')))
-    else:
-        price = price_hist
-
-    # If end_inv is not provided, fill it with None values to match the length of other lists
+def gen_results_rows(timestamp, gameid, gametype, groupid, price_hist, ncust, sales, end_inv=None):
+    """Rows of the results table (in RESULTS_COLUMNS order) from price_hist and other lists"""
+    # If end_inv is not provided (game types without inventory), fill it with None values
     if end_inv is None:
-        end_inv = [None] * len(price)
-    
-    # Ensure all lists have the same length by determining the minimum length
-    min_length = min(len(price), len(ncust), len(sales), len(end_inv))
-    if len(price) != min_length or len(ncust) != min_length or len(sales) != min_length or len(end_inv) != min_length:
-        print(f"Adjusting lists to minimum length of {min_length}")
-        price = price[:min_length]
-        ncust = ncust[:min_length]
-        sales = sales[:min_length]
-        end_inv = end_inv[:min_length]
-
-    # Confirm lists are now of equal length
-    if len(price) == len(ncust) == len(sales) == len(end_inv):
-        print("All lists are of equal length and ready for DataFrame creation.")
-    else:
-        raise ValueError("All lists must be of the same length.")
+        end_inv = [None] * len(price_hist)
 
-    # Construct DataFrame
-    data = {
-        'timestamp': [timestamp] * min_length,
-        'gameid': [gameid] * min_length,
-        'gametype': [gametype] * min_length,
-        'groupid': [groupid] * min_length,
-        'period': list(range(1, min_length + 1)),
-        'price': price,
-        'ncust': ncust,
-        'sales': sales,
-        'end_inv': end_inv,
-    }
+    nperiods = len(price_hist)
+    if not len(ncust) == len(sales) == len(end_inv) == nperiods:
+        raise ValueError("All lists must be of the same length.")
+    if not 1 <= nperiods <= NPERIODS:
+        raise ValueError(f"Results must have between 1 and {NPERIODS} weeks.")
+    # checked here, before the rows are queued (a write-behind submission is acknowledged first)
+    if not groupid:
+        raise ValueError("Missing group name.")
+    if not np.all(np.isfinite(np.asarray(price_hist, dtype=float))):
+        raise ValueError("Prices must be numbers.")
 
-    df = pd.DataFrame(data)
-    return df
+    return [(timestamp, gameid, gametype, groupid, t + 1, price_hist[t], ncust[t], sales[t], end_inv[t])
+            for t in range(nperiods)]
 
 
 #------------------------------------------------------------
@@ -495,28 +658,27 @@ def results_dashboard():
 
     if isnew == 1:  # if new game, insert into database as open game
         currtime = datetime.datetime.now()
-        data = {'gameid': [gameid], 'gamestatus': ['open'], 'timestamp': [str(currtime)]}
-        df = pd.DataFrame(data)
-        with sql.connect(DATABASE) as con:
-            df.to_sql('games', con=con, if_exists='append', index=False)
-            con.commit()
+        # a resubmitted form, or two instructors offered the same id, reopen the existing game
+        db.execute("""INSERT INTO games (gameid, gamestatus, timestamp) VALUES (?, ?, ?)
+                      ON CONFLICT (gameid) DO UPDATE SET gamestatus = excluded.gamestatus""",
+                   (gameid, 'open', str(currtime)))
+        OPEN_GAMES.invalidate()
 
     # get list of open games
     gamelist = get_active_games()
 
-    fig1 = draw_results_allgroups(gameid= gameid, gametype= gametype)
-    fig1.sizing_mode='scale_width'
-    fig2 = overall_standing(gameid= gameid)
-    fig2.sizing_mode='scale_width'
+    # read own writes: results queued by this worker must be in the database
+    flush_pending()
+    version, updated = get_results_version(gameid)
 
-    # grab the static resources
-    js_resources = INLINE.render_js()
-    css_resources = INLINE.render_css()
-    # render template
-    # scale to container size
-    #fig = column(fig1, fig2, sizing_mode="scale_height")
-    fig = column(fig1, fig2,sizing_mode='scale_width')
-    script, div = components(fig)
+    # The page only changes with the results version, the open games and the Bokeh bundle
+    etag = hashlib.sha1(repr((gameid, gametype, version, gamelist, bokeh_resources_version())).encode()).hexdigest()
+    last_modified = datetime.datetime.fromtimestamp(updated, datetime.timezone.utc) if updated else None
+    if request.method == 'GET' and is_not_modified(etag, last_modified):
+        return dashboard_response(Response(status=304), etag, last_modified)
+
+    script, div, last_id = get_dashboard_components(gameid, gametype, version)
+    js_resources, css_resources = bokeh_resources()
 
     html = render_template('results_dashboard.html',
                            gameid= gameid,
@@ -526,9 +688,96 @@ def results_dashboard():
                            plot_script=script,
                            plot_div=div,
                            js_resources=js_resources,
-                           css_resources=css_resources
+                           css_resources=css_resources,
+                           last_id=last_id,
+                           etag=etag,
+                           poll_interval=SSE_FALLBACK_POLL
                            )
-    return (html)
+    return dashboard_response(make_response(html), etag, last_modified)
+
+
+def get_dashboard_components(gameid, gametype, version):
+    """Script, div and last result id of the dashboard graphs, cached by results version"""
+    key = (gameid, gametype, version)
+    cached = DASHBOARD_CACHE.get(key)
+    if cached is None:
+        from bokeh.layouts import column
+        # the live stream sends the results inserted after this id
+        last_id = get_last_result_id(gameid)
+        fig1 = draw_results_allgroups(gameid= gameid, gametype= gametype)
+        fig1.sizing_mode='scale_width'
+        fig2 = overall_standing(gameid= gameid)
+        fig2.sizing_mode='scale_width'
+
+        # scale to container size
+        #fig = column(fig1, fig2, sizing_mode="scale_height")
+        fig = column(fig1, fig2,sizing_mode='scale_width')
+        script, div = render_components(fig)
+        cached = (script, div, last_id)
+        DASHBOARD_CACHE.put(key, cached)
+    return cached
+
+
+def is_not_modified(etag, last_modified):
+    """True if the conditional headers of the request match the current page"""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def dashboard_response(response, etag, last_modified):
+    """Adds the validators of the dashboard page; browsers revalidate on every load"""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/dashboard/stream')
+def dashboard_stream():
+    """Server-sent events with the results of a game inserted after last_id.
+
+    Each 'update' event has the new rows and the new standings of the groups
+    that submitted, which the dashboard appends to its graphs."""
+    try:
+        gameid = int(request.args.get('gameid'))
+        # on reconnection, the browser sends the id of the last event received
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_id') or 0)
+    except (TypeError, ValueError):
+        return jsonify(error="Invalid game id"), 400
+    if not SSE_SLOTS.acquire(blocking=False):
+        # the browser does not reconnect after an error status: the page polls instead
+        return jsonify(error="Too many live dashboards, polling instead"), 503
+
+    def events(last_id):
+        yield f"retry: {int(SSE_POLL_INTERVAL*2000)}\n\n"
+        start = last_sent = time.monotonic()
+        while time.monotonic() - start < SSE_MAX_DURATION:
+            rows = get_new_results(gameid, last_id)
+            if rows:
+                last_id = rows[-1][0]
+                groups = {(row[1], row[2]) for row in rows}
+                data = {'rows': [dict(zip(('id', 'groupid', 'gametype', 'period', 'price'), row)) for row in rows],
+                        'standings': [{'groupid': groupid, 'gametype': gametype, 'revenue': revenue,
+                                       'gap': get_gap(gameid, gametype, revenue)}
+                                      for groupid, gametype, revenue in get_group_standings(gameid, groups)]}
+                yield f"id: {last_id}\nevent: update\ndata: {json.dumps(data)}\n\n"
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > SSE_KEEPALIVE:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(SSE_POLL_INTERVAL)
+
+    response = Response(events(last_id), mimetype='text/event-stream')
+    # released when the response is closed, whether the stream ended or the client went away
+    response.call_on_close(SSE_SLOTS.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'    # disable proxy buffering
+    return response
 
 
 @app.route('/adminLogin')
@@ -538,7 +787,7 @@ def admin_login():
     # first game id to try
     newgameid = 12345
 
-    while newgameid in gamelist:
+    while newgameid in OPEN_GAMES:
         newgameid = random.randint(10000, 99999)
     html = render_template('login_admin.html',
                            newgameid = newgameid,
@@ -549,44 +798,76 @@ def admin_login():
 
 @app.route('/get_results')
 def retrieve_results():
-    con = sql.connect(DATABASE)
-    df = pd.read_sql('SELECT * FROM results', con=con)
-    con.close()
-    return(df.to_html())
-
-
+    """Results as paginated HTML, or streamed with format=csv or format=ndjson"""
+    flush_pending()
+    if request.args.get('format', 'html') != 'html':
+        return stream_results(request.args)
+    try:
+        where, params = export_filter(request.args)
+        after = request.args.get('after', 0, type=int)
+        page_size = min(request.args.get('page_size', PAGE_SIZE, type=int), MAX_PAGE_SIZE)
+    except ValueError as e:
+        return str(e), 400
+    rows, next_after = results_page(where, params, after, page_size)
+    filters = {k: request.args[k] for k in ('gameid', 'gametype', 'start', 'end', 'page_size')
+               if request.args.get(k)}
+    return render_template('results_table.html', columns=RESULTS_COLUMNS.split(", "),
+                           rows=[row[1:] for row in rows], filters=filters, next_after=next_after)
+
+
+@metrics.timed('figure')
 def draw_results_allgroups(gameid, gametype):
-    with  sql.connect(DATABASE) as con:
-        df = pd.read_sql("""SELECT * FROM results WHERE gameid=%s AND gametype='%s'"""%(gameid, gametype), con=con)
-    names = df['groupid'].unique()
-    colors = color_gen(len(names))
-    print(colors)
+    """Price history of all groups, drawn with one multi_line and one scatter source.
+
+    Rows come sorted from SQLite and are grouped in a single pass. Groups are
+    hidden by index filters (checkbox list), so the number of glyph renderers
+    does not grow with the class size."""
+    from bokeh.layouts import row
+    from bokeh.models import (ColumnDataSource, Legend, LegendItem, HoverTool, CustomJS, CheckboxGroup,
+                              CDSView, IndexFilter)
+    from bokeh.plotting import figure
+    rows = db.query("""SELECT groupid, period, price FROM results
+                       WHERE gameid=? AND gametype=? ORDER BY groupid, period, id""", (gameid, gametype))
+    names = []
+    xs = []
+    ys = []
+    point_group = []
+    for name, group_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        group_rows = list(group_rows)
+        point_group.extend([len(names)]*len(group_rows))
+        names.append(name)
+        xs.append([row[1] for row in group_rows])
+        ys.append([row[2] for row in group_rows])
+    colors = list(color_gen(len(names)))
+
+    # sources and filters are named so that the dashboard stream can append new rows
+    lines = ColumnDataSource(data=dict(groupid=names, xs=xs, ys=ys, color=colors), name="results_lines")
+    points = ColumnDataSource(data=dict(groupid=[names[i] for i in point_group],
+                                        period=[row[1] for row in rows],
+                                        price=[row[2] for row in rows],
+                                        color=[colors[i] for i in point_group],
+                                        group=point_group), name="results_points")
+    lines_filter = IndexFilter(indices=list(range(len(names))), name="results_lines_filter")
+    points_filter = IndexFilter(indices=list(range(len(rows))), name="results_points_filter")
+
     p = figure(aspect_ratio=2.0, sizing_mode="scale_width",
                toolbar_location='above', title="Price history for all groups",
-               tools="pan,wheel_zoom,box_zoom,reset")
-
-    p_dict = dict()
-    p_circ_dict = dict()
-    for n,c in zip(names,colors):
-        source = ColumnDataSource(data=df.loc[df['groupid']==n])
-        p_dict[n] = p.line(x='period',y='price', source=source, color=c, hover_line_width=3 )
-        p_circ_dict[n] = p.circle(x='period', y='price', fill_color=c, size=5, source=source)
-
-    # add hover
-    hover = HoverTool(tooltips=[('Group','@groupid'),('Price','@price')],
-                      renderers= list(p_dict.values()) )
-    p.add_tools(hover)
-
-# Create legend
-    # create the legend items
-    legend_items = [(x, [p_dict[x]]) for x in p_dict]
-    # create the legend
-    legend = Legend(items=legend_items, label_text_font_size='16pt')
-
-    #legend = Legend(items=[(x, [p_dict[x]]) for x in p_dict],
-    #                label_text_font_size='16pt')
-    p.add_layout(legend,'right')
-    p.legend.click_policy = "hide"
+               tools="pan,wheel_zoom,box_zoom,reset", name="results_plot")
+    ml = p.multi_line(xs='xs', ys='ys', source=lines, view=CDSView(filter=lines_filter),
+                      line_color='color', line_width=2, hover_line_width=4)
+    circ = p.circle(x='period', y='price', source=points, view=CDSView(filter=points_filter),
+                    fill_color='color', line_color='color', size=5)
+
+    # add hover: highlight the line of a group, details on the points
+    p.add_tools(HoverTool(tooltips=[('Group','@groupid')], renderers=[ml]))
+    p.add_tools(HoverTool(tooltips=[('Group','@groupid'),('Week','@period'),('Price','@price')],
+                          renderers=[circ]))
+
+    # Create legend, one item per line of the multi_line (only for small classes)
+    if len(names) <= LEGEND_MAX_GROUPS:
+        legend = Legend(items=[LegendItem(label=n, renderers=[ml], index=i) for i, n in enumerate(names)],
+                        label_text_font_size='16pt')
+        p.add_layout(legend,'right')
     p.xaxis.axis_label = 'Week'
     p.xaxis.axis_label_text_font_size = '18pt'
     p.xaxis.major_label_text_font_size = '16pt'
@@ -594,17 +875,30 @@ def draw_results_allgroups(gameid, gametype):
     p.yaxis.axis_label_text_font_size = '18pt'
     p.yaxis.major_label_text_font_size = '14pt'
 
+    # Show or hide groups by filtering their indices
+    groups = CheckboxGroup(labels=list(names), active=list(range(len(names))), name="results_groups",
+                           width=150)
+    groups.js_on_change('active', CustomJS(
+        args=dict(lines=lines, points=points, lines_filter=lines_filter, points_filter=points_filter),
+        code="""
+            const active = new Set(cb_obj.active);
+            lines_filter.indices = [...active].sort((a, b) => a - b);
+            points_filter.indices = Array.from(points.data.group.keys()).filter((j) => active.has(points.data.group[j]));
+            lines.change.emit();
+            points.change.emit();
+        """))
+
     # TO DO
     # - Add sales for this round, bar graph
-    # - Add hover tools
-    return p
+    return row(p, groups, sizing_mode='scale_width')
 
+@metrics.timed('figure')
 def overall_standing(gameid):
-    with  sql.connect(DATABASE) as con:
-        df = pd.read_sql("""SELECT groupid, gametype, sum(price*sales) AS revenue
-                            FROM results
-                            WHERE (gameid='%s')
-                            GROUP BY groupid, gametype"""%(gameid), con=con)
+    import pandas as pd
+    from bokeh.models import ColumnDataSource, Legend, HoverTool
+    from bokeh.plotting import figure
+    # one row per group and game type, from the standings table
+    df = pd.DataFrame(get_standings(gameid), columns=['groupid', 'gametype', 'revenue', 'units', 'periods'])
 
 
     if df['revenue'].count()==0:
@@ -616,30 +910,35 @@ def overall_standing(gameid):
     colors = color_gen(len(games))
 
 
-    # Calculate total revenue to sort
-    totrevenue = df.groupby("groupid", as_index=False)['revenue'].sum()
-    totrevenue.sort_values(by=['revenue'], inplace=True)
-    names = totrevenue['groupid'].unique()
+    with metrics.span('pandas'):
+        # Calculate total revenue to sort
+        totrevenue = df.groupby("groupid", as_index=False)['revenue'].sum()
+        totrevenue.sort_values(by=['revenue'], inplace=True)
+        names = totrevenue['groupid'].unique()
 
-    # Pivot table to create stacked chart
-    df2 = df.pivot(index='groupid', columns='gametype', values='revenue').reset_index()
-    df2 = df2.fillna(0)
-    df2['revenue']= df2[games].sum(axis=1)
+        # Pivot table to create stacked chart
+        df2 = df.pivot(index='groupid', columns='gametype', values='revenue').reset_index()
+        # optimality gap of each group in each game (nan if not played)
+        for game in games:
+            df2[f'{game}_gap'] = [get_gap(gameid, game, r) if r == r else float('nan') for r in df2[game]]
+        df2[games] = df2[games].fillna(0)
+        df2['revenue']= df2[games].sum(axis=1)
 
-    source = ColumnDataSource(df2)
+    source = ColumnDataSource(df2, name="standings_source")
 
     p = figure(height=250, y_range = names,
                toolbar_location='above', title="Overall standing",
-               tools="pan,wheel_zoom,box_zoom,reset")
+               tools="pan,wheel_zoom,box_zoom,reset", name="standings_plot")
     v = p.hbar_stack(games, y='groupid', height=0.8, source=source, color=colors)
 
     # add hover
-    tooltips = [(game, f'@{game}{{0.0}}') for game in games]
+    tooltips = [(game, f'@{game}{{0.0}} (gap @{game}_gap{{0.0}}%)') for game in games]
     hover = HoverTool(tooltips=tooltips)
     #hover = HoverTool(tooltips=[('Group', '@groupid'),('Total revenue','@revenue')])
     p.add_tools(hover)
 
-    legend = Legend(items=[(GAMENAMES[games[x]], [v[x]]) for x in range(len(games))],
+    # the optimal revenue of each game is the benchmark of the gaps
+    legend = Legend(items=[(legend_label(gameid, games[x]), [v[x]]) for x in range(len(games))],
                     label_text_font_size='16pt')
     p.add_layout(legend,'right')
 
@@ -647,46 +946,102 @@ def overall_standing(gameid):
 
     return p
 
-@app.route('/download_results', methods=['POST'])
+def legend_label(gameid, gametype):
+    if gametype not in GAMETYPES:
+        return gametype
+    return f"{GAMENAMES[gametype]} (optimal {get_optimal(gameid, gametype).revenue:,.0f})"
+
+@app.route('/api/leaderboard')
+def leaderboard_api():
+    """Standings of a game as JSON, sorted by total revenue, with the optimality gaps"""
+    try:
+        gameid = int(request.args.get('gameid'))
+    except (TypeError, ValueError):
+        return jsonify(error="Invalid game id"), 400
+
+    flush_pending()
+    groups = {}
+    for groupid, gametype, revenue, units, periods in get_standings(gameid):
+        group = groups.setdefault(groupid, {'groupid': groupid, 'revenue': 0.0, 'units': 0, 'optimal': 0.0,
+                                            'games': {}})
+        optimal_revenue = get_optimal(gameid, gametype).revenue if gametype in GAMETYPES else None
+        group['revenue'] += revenue
+        group['units'] += units
+        group['optimal'] += optimal_revenue or 0.0
+        group['games'][gametype] = {'revenue': revenue, 'units': units, 'periods': periods,
+                                    'optimal': optimal_revenue, 'gap': get_gap(gameid, gametype, revenue)}
+    for group in groups.values():
+        group['gap'] = optimal.optimality_gap(group['revenue'], group['optimal'])
+    standings = sorted(groups.values(), key=lambda g: g['revenue'], reverse=True)
+    return jsonify(gameid=gameid, standings=standings)
+
+
+@app.route('/api/evaluate')
+def evaluate_api():
+    """Expected revenue of a price path over random scenarios of a game type (see montecarlo.py).
+
+    The path is given as prices=p1,p2,..., or read from the results of groupid
+    in gameid; policy=optimal evaluates the optimal policy of the scenario of
+    gameid instead. All the policies of a game are evaluated on the same scenarios."""
+    gametype = request.args.get('gametype')
+    if gametype not in GAMETYPES:
+        return jsonify(error="Invalid game type"), 400
+    gameid = request.args.get('gameid')
+    try:
+        n = min(request.args.get('n', MC_SCENARIOS, type=int), MC_MAX_SCENARIOS)
+        if request.args.get('policy') == 'optimal':
+            policy = get_optimal(int(gameid), gametype)
+        elif request.args.get('prices'):
+            policy = csvstr_to_numarr(request.args['prices'])
+        else:
+            flush_pending()
+            policy = [row[0] for row in db.query("""SELECT price FROM results WHERE gameid=? AND gametype=?
+                                                    AND groupid=? ORDER BY period, id""",
+                                                 (int(gameid), gametype, request.args.get('groupid')))]
+    except (TypeError, ValueError):
+        return jsonify(error="Invalid input"), 400
+    if not callable(policy) and len(policy) != NPERIODS:
+        return jsonify(error=f"The price path must have {NPERIODS} prices"), 400
+
+    init_inv = INITINV if HASINV[gametype] else None
+    mc = MonteCarlo.from_service(SCENARIOS, gametype, init_inv)
+    result = mc.evaluate(policy, max(n, 1), seed=[SEED, game_key(gameid)])
+    return jsonify(gametype=gametype, **result)
+
+
+@app.route('/download_results', methods=['GET', 'POST'])
 #@app.route('/download_csv')
 def download_table():
-    # Get input values from form
-    filter_value = request.form['gameid']
-    #filter_value = '12345'
-
-    # Connect to database
-    conn = sql.connect(DATABASE)
-    cursor = conn.cursor()
-
-    # Construct SQL query with filter
-    query = f"SELECT * FROM results WHERE gameid='{filter_value}'"
-
-    # Retrieve data from database
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    cols = [desc[0] for desc in cursor.description]
-
-    output = StringIO()
-    writer = csv.writer(output)
+    """Streams the results of a game as CSV or NDJSON (format=ndjson), gzip-compressed with gzip=1"""
+    flush_pending()
+    # all the rounds of the game: the dashboard form that posts here always sends its gametype
+    values = {k: v for k, v in request.values.items() if k != 'gametype'}
+    return stream_results(values)
 
-    writer.writerow(cols)
-    # write the query results to the CSV
-    for row in rows:
-        writer.writerow(row)
-        print(row)
 
-    response = make_response(output.getvalue())
-    response.headers['Content-Disposition'] = f'attachment; filename=results_{filter_value}.csv'
-    response.headers['Content-Type'] = 'text/csv'
+def export_filter(values):
+    """WHERE clause and parameters from the gameid, gametype, start and end request values"""
+    return results_filter(values.get('gameid'), values.get('gametype'),
+                          values.get('start'), values.get('end'))
 
-    # Close database connection
-    cursor.close()
-    conn.close()
 
+def stream_results(values):
+    """Streamed export response for the filters and format of a request"""
+    try:
+        where, params = export_filter(values)
+        chunks, mimetype, extension = export_results(values.get('format', 'csv'),
+                                                     values.get('gzip') in ('1', 'true', 'on'),
+                                                     where, params)
+    except ValueError as e:
+        return str(e), 400
+    filename = f"results_{values.get('gameid') or 'all'}.{extension}"
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
     return response
 
 def color_gen(ncolors):
     """ generates list of colors for bokeh graph"""
+    from bokeh.palettes import Category10, Category20, Inferno256, inferno
     #yield from itertools.cycle(Category10[10])
     if ncolors < 3:
         colorlist = Category10[3][0:ncolors]
@@ -694,46 +1049,59 @@ def color_gen(ncolors):
         colorlist = Category10[ncolors]
     elif ncolors <= 20:
         colorlist = Category20[ncolors]
-    else:
+    elif ncolors <= 256:
         colorlist = inferno(ncolors)
+    else:
+        # more groups than colors in the palette: neighbouring groups share colors
+        colorlist = [Inferno256[i*256//ncolors] for i in range(ncolors)]
     return colorlist
 
 
 @app.route('/manage_games', methods=['GET', 'POST'])
 def manage_games():
+    flush_pending()
     active_games = [str(game) for game in get_active_games()]  # Ensure all game IDs are strings
     selected_gameid = None
-    game_results = pd.DataFrame()
+    game_results = []
 
     if request.method == 'POST':
         selected_gameid = str(request.form.get('gameid'))  # Convert selected game ID to string
 
         # Handle filtering
         if 'filter' in request.form and selected_gameid:
-            with sql.connect(DATABASE) as con:
-                query = "SELECT * FROM results WHERE gameid = ?"
-                game_results = pd.read_sql(query, con, params=(selected_gameid,))
+            query = f"SELECT {RESULTS_COLUMNS} FROM results WHERE gameid = ?"
+            game_results = [dict(zip(RESULTS_COLUMNS.split(", "), row))
+                            for row in db.query(query, (selected_gameid,))]
 
         # Handle deletion
         elif 'delete' in request.form and selected_gameid:
-            with sql.connect(DATABASE) as con:
-                cur = con.cursor()
-                # Delete from both tables
-                cur.execute("DELETE FROM results WHERE gameid = ?", (selected_gameid,))
-                cur.execute("DELETE FROM games WHERE gameid = ?", (selected_gameid,))
-                con.commit()
+            delete_game(int(selected_gameid))
+            OPEN_GAMES.invalidate()
             return redirect(url_for('manage_games'))
 
     return render_template(
         'manage_games.html',
         active_games=active_games,
         selected_gameid=selected_gameid,
-        game_results=game_results.to_dict(orient='records')
+        game_results=game_results
     )
 
 
 # ------------- RUN APP ----------------------------
 
+# Build the BokehJS bundle and the main game graphs before the first request
+if PRELOAD_BOKEH:
+    if BOKEH_RESOURCES == 'static':
+        get_bokeh_assets()
+    else:
+        inline_bokeh_resources()
+    for g in GAMETYPES:
+        get_maingame_components(g)
+    startup.checkpoint('bokeh')
+
+if STARTUP_REPORT:
+    print(startup.report())
+
 # for testing
 #if __name__ == '__main__':
 #    app.run(debug=True, port=5000)
@@ -760,10 +1128,11 @@ if __name__ == "__main__":
 
 # ----------------- OLD CODE ----------------------------
 
-def gen_results_table_OLD(timestamp, gameid, gametype, groupid, price_hist, init_inv,valuations):
+def gen_results_table_OLD(timestamp, gameid, gametype, groupid, price_hist, init_inv, demand):
     """ Calculates results table from price_hist string"""
+    import pandas as pd
     price = csvstr_to_numarr(price_hist)
-    (sales,ncust) = get_sales_hist(price, init_inv,valuations)
+    (sales,ncust) = get_sales_hist(price, init_inv, demand)
     cumsales = np.cumsum(sales)
     nperiods = len(price)
     period = np.array(range(1,nperiods+1))
@@ -792,12 +1161,11 @@ def gen_results_table_OLD(timestamp, gameid, gametype, groupid, price_hist, init
 
 @app.route("/<string:gametype>", methods = ['POST'])
 def index(gametype):
-    global NPERIODS, VALUATIONS, GAMETYPES, HASINV, GAMEVALUES
+    global NPERIODS, GAMETYPES, HASINV, GAMEVALUES
 
     gameid = request.form.get("gameid")
     groupname = request.form.get("groupname")
-    gamelist = get_active_games()
-    if int(gameid) not in gamelist:
+    if int(gameid) not in OPEN_GAMES:
         return ("""<h2> Invalid game password </h2> \n
                 <a href ="/login" class="link_button"> Back to login </a>""")
 
@@ -806,72 +1174,57 @@ def index(gametype):
         return("""<h2> URL not found </h2>""")
     elif not HASINV[gametype]:
         init_inv = None
-        inventory = None
     else:
         init_inv = INITINV
-        inventory = request.form.get("inv")
 
-    valuations = VALUATIONS[gametype]
+    demand = SCENARIOS.get(gameid, gametype)
+    key = (int(gameid), groupname, gametype)
 
     price = request.form.get("price")
     stage = request.form.get("stage")
     price_hist = request.form.get("price_hist")
 
-    if init_inv and inventory == None:
-        # Sets inventory to initial inventory in the first stage
-        inventory = init_inv
-
     if price and stage:     # this is passed after stage 1.
         stagenum = int(stage)
-        sales = get_sales(float(price),valuations[stagenum-1])
-        ncust = len(valuations[stagenum-1])
-        salesnum = int(sales)
-
-        if inventory == None:
-            invnum = float("inf")
-        else:
-            invnum = int(inventory)
-
-        salesnum = min(salesnum,invnum)
-        invnum = invnum - salesnum
+        state = load_game_state(key, gametype, stagenum, price_hist)
+        if state['week'] != stagenum - 1:
+            return ("""<h2> Missing prices of the previous weeks </h2> \n
+                    <a href ="/login" class="link_button"> Back to login </a>""")
+        salesnum, ncust, invnum = play_week(demand, stagenum-1, float(price), state['inv'])
+        state = GAMESTATE.record(key, state, float(price), salesnum, ncust, invnum)
         sales = str(salesnum)
 
-        if invnum < float("inf"):
-            inventory = str(invnum)
-
         price_hist = price_hist+price+","
         stagenum = stagenum + 1
     else:                   # set the first stage
+        state = GAMESTATE.start(key, init_inv)
         price_hist=""
         stagenum = 1
 
     stage = str(stagenum)
+    inventory = None if state['inv'] is None else str(state['inv'])
 
     # Matplotlib graph
-    #fig = draw_graph(price_hist,init_inv,valuations)
+    #fig = draw_graph(price_hist,init_inv,demand)
     # Save it to a temporary buffer.
     #buf = BytesIO()
     #fig.savefig(buf, format="png")
     # Embed the result in the html output.
     #data = base64.b64encode(buf.getbuffer()).decode("ascii")
 
-    # Bokeh graph
-    bfig = draw_bokeh_graph(price_hist, init_inv, valuations)
+    # Bokeh graph, drawn from the weeks stored in the game state
+    bfig = draw_bokeh_graph(price_hist, init_inv, demand, steps=GAMESTATE.history(key))
     # grab the static resources
-    js_resources = INLINE.render_js()
-    css_resources = INLINE.render_css()
+    js_resources, css_resources = bokeh_resources()
     # render template
-    script, div = components(bfig)
+    script, div = render_components(bfig)
 
-    if price_hist:
-        # if there is price history, calculate revenues up to current stage
-        price_arr = csvstr_to_numarr(price_hist)
-        (sales_arr, ncust_arr) = get_sales_hist(price_arr, init_inv, valuations)
-        totrevenue = np.dot(price_arr, sales_arr)
+    # revenues up to current stage
+    totrevenue = state['revenue']
 
     if stagenum == 1:
         return render_template('welcome.html', gameid=gameid, groupname= groupname,
-                               has_inv = HASINV[gametype],
+                               has_inv = HASINV[gametype], gametype= gametype,
                                valuetype = GAMEVALUES[gametype][stagenum-1],
                                value_list = GAMEVALUES[gametype],
                                typename=GAMENAMES[gametype],
@@ -880,12 +1233,15 @@ def index(gametype):
                                plot_script=script,
                                plot_div=div,
                                js_resources=js_resources,
-                               css_resources=css_resources
+                               css_resources=css_resources,
+                               revenue=0
                                )
     elif stagenum <= NPERIODS:
         return render_template('base.html', gameid=gameid, groupname= groupname,
-                               has_inv = HASINV[gametype],
+                               has_inv = HASINV[gametype], gametype= gametype,
                                valuetype=GAMEVALUES[gametype][stagenum - 1],
+                               value_list = GAMEVALUES[gametype],
+                               nperiods = str(NPERIODS),
                                typename = GAMENAMES[gametype],
                                sales = int(sales), ncust = ncust,
                                stage = stage,
@@ -909,14 +1265,48 @@ def index(gametype):
                                plot_div=div,
                                js_resources=js_resources,
                                css_resources=css_resources,
-                               cumsales= sum(sales_arr), revenue=totrevenue)
+                               cumsales= state['cumsales'], revenue=totrevenue)
+
+
+@app.route("/api/step/<string:gametype>", methods = ['POST'])
+def step_api(gametype):
+    """Plays one week of the /<gametype> flow and returns the result as JSON.
+
+    The page appends the new week to its graphs instead of reloading.
+    Inventory and revenue are taken from the server-side game state."""
+    if not gametype in GAMETYPES:
+        return jsonify(error="URL not found"), 404
+
+    try:
+        gameid = int(request.form.get("gameid"))
+        stagenum = int(request.form.get("stage"))
+        pricenum = float(request.form.get("price"))
+    except (TypeError, ValueError):
+        return jsonify(error="Invalid input"), 400
+
+    if gameid not in OPEN_GAMES:
+        return jsonify(error="Invalid game password"), 403
+    if not 1 <= stagenum <= NPERIODS:
+        return jsonify(error="Invalid stage"), 400
+
+    key = (gameid, request.form.get("groupname"), gametype)
+    state = load_game_state(key, gametype, stagenum, request.form.get("price_hist"))
+    if state['week'] != stagenum - 1:
+        # neither the store nor price_hist have the weeks before this one
+        return jsonify(error="Missing prices of the previous weeks"), 400
+    salesnum, ncust, invnum = play_week(SCENARIOS.get(gameid, gametype), stagenum-1, pricenum, state['inv'])
+    state = GAMESTATE.record(key, state, pricenum, salesnum, ncust, invnum)
+
+    return jsonify(week=stagenum, price=pricenum, sales=salesnum, ncust=ncust,
+                   inv=state['inv'], revenue=state['revenue'], stage=stagenum + 1,
+                   valuetype=GAMEVALUES[gametype][stagenum] if stagenum < NPERIODS else None,
+                   gameover=stagenum >= NPERIODS)
 
 
 #@app.route("/results/<string:gametype>", methods = ['POST'])
 def send_results_OLD(gametype):
-    global VALUATIONS, GAMETYPES, HASINV
+    global GAMETYPES, HASINV
 
-    valuations = VALUATIONS[gametype]
     if not gametype in GAMETYPES:
         return("""<h2> URL not found </h2>""")
     elif HASINV[gametype]:
@@ -928,12 +1318,11 @@ def send_results_OLD(gametype):
     gameid = request.form.get("gameid")
     if price_hist:
         currtime = datetime.datetime.now()
-        df = gen_results_table(timestamp=str(currtime), gameid= gameid, gametype= gametype, groupid=groupname,
-                               price_hist= price_hist, init_inv= init_inv, valuations= valuations)
+        df = gen_results_table_OLD(timestamp=str(currtime), gameid= gameid, gametype= gametype, groupid=groupname,
+                                   price_hist= price_hist, init_inv= init_inv, demand= SCENARIOS.get(gameid, gametype))
         try:
-            with sql.connect(DATABASE) as con:
+            with db.transaction() as con:
                 df.to_sql('results',con=con, if_exists='append', index= False)
-                con.commit()
             saved = True
         except Exception as e:
             saved = False
@@ -957,14 +1346,14 @@ def send_results_OLD(gametype):
 
 @app.route('/bokeh_test')
 def bokeh_test():
+    from bokeh.layouts import column
     fig1 = draw_results_allgroups(gameid=12345, gametype="inv")
     fig2 = overall_standing(gameid=12345)
     # grab the static resources
-    js_resources = INLINE.render_js()
-    css_resources = INLINE.render_css()
+    js_resources, css_resources = bokeh_resources()
     # render template
     fig = column(fig1,fig2)
-    script, div = components(fig)
+    script, div = render_components(fig)
 
     html = render_template('test.html',
                            plot_script=script,
@@ -0,0 +1,201 @@
+# Request latency metrics
+# Every request is timed by Flask hooks, and the time spent in its phases
+# (database, figures, Bokeh components, templates, ...) is measured with
+# span(). Phase times are exclusive: the database queries run while building
+# a figure count as 'db', not as 'figure'; whatever is left is 'other'. Each
+# worker keeps histograms per (route, phase) and, with a metrics directory,
+# writes them to metrics-<pid>.json there, so that /metrics can add up all
+# the gunicorn workers. The output is in the Prometheus text format.
+
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FLUSH_INTERVAL = 1.0    # seconds between writes of the worker's file
+
+METRICS_DIR = None      # set with init_app()
+_histograms = {}        # (route, phase) -> [bucket counts..., sum, count]
+_lock = threading.Lock()
+_local = threading.local()
+_last_flush = 0.0
+_flush_timer = None     # writes the requests of the last interval when no other request comes
+
+
+@contextmanager
+def span(phase):
+    """Adds the time of the block to a phase of the current request"""
+    phases = getattr(_local, 'phases', None)
+    if phases is None:      # outside of a request (startup, streamed responses)
+        yield
+        return
+    stack = _local.stack
+    stack.append(0.0)       # time of the spans nested in this one
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        phases[phase] = phases.get(phase, 0.0) + elapsed - nested
+        if stack:
+            stack[-1] += elapsed
+
+
+def timed(phase):
+    """Decorator: every call of the function is a span of phase"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe(route, phase, seconds):
+    with _lock:
+        hist = _histograms.get((route, phase))
+        if hist is None:
+            hist = _histograms[(route, phase)] = [0]*len(BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+                break
+        hist[-2] += seconds
+        hist[-1] += 1
+
+
+def _before_request():
+    _local.phases = {}
+    _local.stack = []
+    _local.start = time.perf_counter()
+
+
+def _after_request(response):
+    from flask import request
+    phases = getattr(_local, 'phases', None)
+    if phases is None:
+        return response
+    total = time.perf_counter() - _local.start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    observe(route, 'total', total)
+    for phase, seconds in phases.items():
+        observe(route, phase, seconds)
+    observe(route, 'other', max(total - sum(phases.values()), 0.0))
+    _local.phases = None
+    if METRICS_DIR:
+        if time.monotonic() - _last_flush > FLUSH_INTERVAL:
+            flush()
+        else:
+            _schedule_flush()
+    return response
+
+
+def _schedule_flush():
+    global _flush_timer
+    with _lock:
+        if _flush_timer is not None and _flush_timer.is_alive():
+            return
+        _flush_timer = threading.Timer(FLUSH_INTERVAL, flush)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+def init_app(app, metrics_dir=None):
+    """Times the requests of app; with metrics_dir, shares the histograms between processes"""
+    global METRICS_DIR
+    METRICS_DIR = metrics_dir
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        _remove_dead(metrics_dir)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove_dead(metrics_dir):
+    """Removes the files of workers that are gone (their counters restart from zero)"""
+    for path in glob.glob(os.path.join(metrics_dir, 'metrics-*.json')):
+        try:
+            pid = int(os.path.basename(path)[len('metrics-'):-len('.json')])
+        except ValueError:
+            continue
+        if not _pid_alive(pid):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def flush():
+    """Writes the histograms of this worker to its file in METRICS_DIR"""
+    global _last_flush
+    with _lock:
+        data = [[route, phase, hist] for (route, phase), hist in _histograms.items()]
+        _last_flush = time.monotonic()
+    path = os.path.join(METRICS_DIR, f'metrics-{os.getpid()}.json')
+    tmp = f'{path}.{threading.get_ident()}.tmp'     # threads of the worker may flush at once
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def collect():
+    """Histograms of all the workers (or of this process only, without METRICS_DIR)"""
+    if not METRICS_DIR:
+        with _lock:
+            return {key: list(hist) for key, hist in _histograms.items()}
+    flush()
+    total = {}
+    for path in glob.glob(os.path.join(METRICS_DIR, 'metrics-*.json')):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for route, phase, hist in data:
+            acc = total.setdefault((route, phase), [0]*len(BUCKETS) + [0.0, 0])
+            for i, value in enumerate(hist):
+                acc[i] += value
+    return total
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(histograms):
+    """Prometheus text format of the histograms"""
+    lines = []
+    for name, doc, phase_label in [
+            ('valuation_game_request_duration_seconds', 'Request latency per route', False),
+            ('valuation_game_phase_duration_seconds', 'Time per request spent in each phase', True)]:
+        lines.append(f'# HELP {name} {doc}')
+        lines.append(f'# TYPE {name} histogram')
+        for (route, phase), hist in sorted(histograms.items()):
+            if (phase == 'total') == phase_label:
+                continue
+            labels = f'route="{_escape(route)}"' + (f',phase="{_escape(phase)}"' if phase_label else '')
+            cumulative = 0
+            for bound, count in zip(BUCKETS, hist):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {hist[-1]}')
+            lines.append(f'{name}_sum{{{labels}}} {hist[-2]}')
+            lines.append(f'{name}_count{{{labels}}} {hist[-1]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,103 @@
+# Monte Carlo evaluation of pricing policies
+# A policy is evaluated over N independent scenarios of a game type, drawn
+# like the per-game scenarios (see scenarios.py) but all at once: valuations
+# are an array of shape (scenarios, weeks, max customers), and the customers
+# beyond the number of each week are masked out. Scenarios are processed in
+# chunks to bound memory, optionally in a process pool. Each chunk has its
+# own seed, spawned from the seed of the evaluation, so the result does not
+# depend on the number of processes.
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+CHUNK_SIZE = 20000     # scenarios per chunk
+
+
+class MonteCarlo:
+    """Random scenarios of one game type"""
+
+    def __init__(self, values, ranges, weektypes, ncust_range, init_inv=None):
+        self.values = values            # sorted valuations of the empirical distribution
+        self.ranges = ranges            # valuation type -> (start, stop) indices into values
+        self.weektypes = weektypes      # valuation type of each week
+        self.ncust_range = ncust_range  # (low, high) customers per week, both included
+        self.init_inv = init_inv        # None: no inventory limit
+
+    @classmethod
+    def from_service(cls, service, gametype, init_inv=None):
+        """MonteCarlo with the distribution and settings of a ScenarioService"""
+        return cls(service.values, service.ranges, service.gamevalues[gametype], service.ncust_range, init_inv)
+
+    def sample(self, rng, n):
+        """(valuations, mask) of n scenarios: arrays of shape (n, weeks, max customers)"""
+        low, high = self.ncust_range
+        nweeks = len(self.weektypes)
+        ncust = rng.integers(low, high, size=(n, nweeks), endpoint=True)
+        bounds = np.array([self.ranges[v] for v in self.weektypes])
+        idx = rng.integers(bounds[None, :, 0, None], bounds[None, :, 1, None], size=(n, nweeks, high))
+        mask = np.arange(high)[None, None, :] < ncust[:, :, None]
+        return np.asarray(self.values)[idx], mask
+
+    def simulate(self, policy, rng, n):
+        """Revenue (n,) and sales (n, weeks) of a policy in n random scenarios.
+
+        policy is a price path (one price per week) or a callable (week,
+        inventory array) -> price array; a nan or None price sells nothing."""
+        vals, mask = self.sample(rng, n)
+        nweeks = len(self.weektypes)
+        revenue = np.zeros(n)
+        sales = np.zeros((n, nweeks), dtype=int)
+        inv = np.full(n, self.init_inv if self.init_inv is not None else np.iinfo(np.int64).max, dtype=np.int64)
+        path = None if callable(policy) else np.array([np.nan if p is None else p for p in policy], dtype=float)
+        for t in range(nweeks):
+            price = np.broadcast_to(np.asarray(policy(t, inv) if path is None else path[t], dtype=float), (n,))
+            demand = np.count_nonzero(mask[:, t, :] & (vals[:, t, :] >= price[:, None]), axis=1)
+            demand[np.isnan(price)] = 0
+            sales[:, t] = np.minimum(demand, inv)
+            inv = inv - sales[:, t]
+            revenue += np.where(sales[:, t] > 0, price*sales[:, t], 0.0)
+        return revenue, sales
+
+    def evaluate(self, policy, n, seed=None, chunk_size=CHUNK_SIZE, workers=None):
+        """Mean and variance of the revenue of a policy over n scenarios.
+
+        With workers, the chunks are simulated in a process pool (the policy
+        must then be picklable: a price path or e.g. an optimal.OptimalPolicy)."""
+        sizes = [min(chunk_size, n - start) for start in range(0, n, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        args = [(self, policy, s, size) for s, size in zip(seeds, sizes)]
+        if workers:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                chunks = list(pool.map(_simulate_chunk, args))
+        else:
+            chunks = [_simulate_chunk(a) for a in args]
+        return combine(chunks)
+
+
+def _simulate_chunk(args):
+    """Summary (n, mean, M2, sales sum) of one chunk of scenarios"""
+    mc, policy, seed, n = args
+    revenue, sales = mc.simulate(policy, np.random.default_rng(seed), n)
+    mean = revenue.mean()
+    return n, mean, float(((revenue - mean)**2).sum()), sales.sum(axis=0)
+
+
+def combine(chunks):
+    """Mean and variance of all the chunks (parallel algorithm of Chan et al.)"""
+    n, mean, m2 = 0, 0.0, 0.0
+    sales = 0
+    for nb, meanb, m2b, salesb in chunks:
+        delta = meanb - mean
+        total = n + nb
+        mean += delta*nb/total
+        m2 += m2b + delta**2*n*nb/total
+        n = total
+        sales = sales + salesb
+    var = m2/(n - 1) if n > 1 else 0.0
+    return {'n': n,
+            'mean': mean,
+            'var': var,
+            'std': var**0.5,
+            'stderr': (var/n)**0.5 if n else 0.0,
+            'mean_sales': (np.asarray(sales)/max(n, 1)).tolist()}
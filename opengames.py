@@ -0,0 +1,52 @@
+# Registry of the open games
+# Every weekly step checks that the game password is an open game. Each
+# worker keeps the open game ids in a set, reloaded when the games version
+# changes: a single-row counter bumped by triggers on the games table, so a
+# game created or deleted in any worker (or by hand) invalidates the sets of
+# all of them. The version is read at most every ttl seconds; an id that is
+# not in the set is re-checked at once, so a new game can be joined right away.
+
+import threading
+import time
+
+import db
+
+
+class OpenGames:
+    """Set of open game ids, shared by the threads of a worker"""
+
+    def __init__(self, ttl=2.0):
+        self.ttl = ttl              # seconds between checks of the games version
+        self._games = frozenset()
+        self._version = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh(self, force=False):
+        """Reloads the ids if the games version changed (checked every ttl seconds, or now with force)"""
+        if not force and time.monotonic() - self._checked < self.ttl:
+            return
+        with self._lock:
+            version = db.query_one("SELECT version FROM games_version")[0]
+            if version != self._version:
+                # read after the version: a change in between only causes one more reload
+                self._games = frozenset(row[0] for row in db.query(
+                    "SELECT gameid FROM games WHERE gamestatus=?", ('open',)))
+                self._version = version
+            self._checked = time.monotonic()
+
+    def __contains__(self, gameid):
+        self._refresh()
+        if gameid in self._games:
+            return True
+        self._refresh(force=True)
+        return gameid in self._games
+
+    def list(self):
+        """Sorted open game ids"""
+        self._refresh()
+        return sorted(self._games)
+
+    def invalidate(self):
+        """Checks the version on next use (after this worker creates or deletes a game)"""
+        self._checked = 0.0
@@ -0,0 +1,77 @@
+# Clairvoyant optimal pricing
+# Knowing the valuations of every week, the best price path is found with a
+# dynamic program over (week, remaining inventory). The candidate prices of a
+# week are its distinct valuations (any other price sells the same units for
+# less), and each step is vectorized over inventory levels x candidate prices.
+# Without inventory, the initial inventory is the total number of customers,
+# which never binds, so the same program maximizes each week separately.
+
+import numpy as np
+
+
+class OptimalPolicy:
+    """Optimal revenue, price path and price for every (week, remaining inventory)"""
+
+    def __init__(self, value, price, sold, init_inv):
+        self.value = value      # (nweeks+1, init_inv+1) optimal revenue from week t with k units left
+        self.price = price      # (nweeks, init_inv+1) optimal price (nan: do not sell)
+        self.sold = sold        # (nweeks, init_inv+1) units sold at that price
+        self.init_inv = init_inv
+        self.revenue = float(value[0, init_inv])
+        self.prices, self.sales = self.path()
+
+    def path(self):
+        """Optimal prices and sales of each week, starting with the initial inventory"""
+        prices, sales = [], []
+        inv = self.init_inv
+        for t in range(self.price.shape[0]):
+            price = self.price[t, inv]
+            prices.append(None if np.isnan(price) else float(price))
+            sales.append(int(self.sold[t, inv]))
+            inv -= sales[-1]
+        return prices, sales
+
+    def __call__(self, week, inv):
+        """Optimal price in week (0-based) with inv units left"""
+        return self.price[week, np.minimum(inv, self.init_inv)]
+
+
+def candidates(vals):
+    """Distinct valuations of a week and the units demanded at each of them as a price"""
+    prices = np.unique(vals)
+    demand = len(vals) - np.searchsorted(vals, prices, side='left')
+    return prices, demand
+
+
+def solve(demand, init_inv=None):
+    """OptimalPolicy for a WeeklyDemand (init_inv None: no inventory limit)"""
+    if init_inv is None:
+        init_inv = int(demand.ncust.sum())
+    nweeks = demand.nperiods
+    inv = np.arange(init_inv + 1)
+    value = np.zeros((nweeks + 1, init_inv + 1))
+    price = np.full((nweeks, init_inv + 1), np.nan)
+    sold = np.zeros((nweeks, init_inv + 1), dtype=int)
+    for t in range(nweeks - 1, -1, -1):
+        prices, units = candidates(demand.weeks[t])
+        if len(prices) == 0:
+            value[t] = value[t + 1]
+            continue
+        # (inventory, candidate): sales are capped by the units left
+        q = np.minimum(units[None, :], inv[:, None])
+        total = prices[None, :]*q + value[t + 1][inv[:, None] - q]
+        best = np.argmax(total, axis=1)
+        best_total = total[inv, best]
+        # selling nothing is an option too (e.g. when later weeks pay more)
+        keep = value[t + 1] >= best_total
+        value[t] = np.where(keep, value[t + 1], best_total)
+        price[t] = np.where(keep, np.nan, prices[best])
+        sold[t] = np.where(keep, 0, q[inv, best])
+    return OptimalPolicy(value, price, sold, init_inv)
+
+
+def optimality_gap(revenue, optimal):
+    """Percentage of the optimal revenue left on the table"""
+    if not optimal:
+        return 0.0
+    return 100.0*(optimal - revenue)/optimal
@@ -0,0 +1,141 @@
+# Persistence of game results
+# Result rows are tuples in the order of schema.RESULTS_COLUMNS. The standings
+# table (total revenue, units and periods of each group and game type) is
+# updated in the same transaction as the rows, so that the dashboard reads
+# one row per group instead of aggregating all the results. The results version
+# of the game (game_versions) is bumped in the same transaction too, so that
+# rendered dashboards can be cached until it changes.
+
+import os
+import sqlite3
+import time
+
+import db
+from schema import RESULTS_COLUMNS
+from writequeue import WriteBehindQueue, replay
+
+INSERT_RESULTS = f"INSERT INTO results ({RESULTS_COLUMNS}) VALUES (?,?,?,?,?,?,?,?,?)"
+UPDATE_STANDINGS = """INSERT INTO standings (gameid, groupid, gametype, revenue, units, periods)
+                      VALUES (?,?,?,?,?,?)
+                      ON CONFLICT (gameid, groupid, gametype) DO UPDATE SET
+                        revenue = revenue + excluded.revenue,
+                        units = units + excluded.units,
+                        periods = periods + excluded.periods"""
+BUMP_VERSION = """INSERT INTO game_versions (gameid, version, updated) VALUES (?, 1, ?)
+                  ON CONFLICT (gameid) DO UPDATE SET
+                    version = version + 1, updated = excluded.updated"""
+
+# Optional write-behind queue for submissions (see enable_write_behind)
+FLUSH_TIMEOUT = 5.0         # seconds a read waits for the queued submissions of its worker
+PERMANENT_ERRORS = (sqlite3.IntegrityError,)    # submissions that no retry will write
+WRITE_BEHIND = None
+_write_behind_pid = None
+_write_behind_config = None
+
+
+def insert_results(rows):
+    """Inserts the rows of a submission with a single executemany, in one transaction"""
+    insert_results_batch([rows])
+
+
+def insert_results_batch(submissions):
+    """Inserts the rows of several submissions in one transaction (group commit)"""
+    with db.transaction() as con:
+        for rows in submissions:
+            con.executemany(INSERT_RESULTS, rows)
+            con.executemany(UPDATE_STANDINGS, standings_deltas(rows))
+        now = time.time()
+        gameids = {row[1] for rows in submissions for row in rows}
+        con.executemany(BUMP_VERSION, [(gameid, now) for gameid in gameids])
+
+
+def get_results_version(gameid):
+    """(version, unix time of last change) of the results of a game; (0, None) if never changed"""
+    row = db.query_one("SELECT version, updated FROM game_versions WHERE gameid=?", (gameid,))
+    return row if row is not None else (0, None)
+
+
+def standings_deltas(rows):
+    """Revenue, units and periods added by result rows, per (gameid, groupid, gametype)"""
+    deltas = {}
+    for (timestamp, gameid, gametype, groupid, period, price, ncust, sales, end_inv) in rows:
+        revenue, units, periods = deltas.get((gameid, groupid, gametype), (0.0, 0, 0))
+        deltas[(gameid, groupid, gametype)] = (revenue + (price or 0)*(sales or 0),
+                                               units + (sales or 0), periods + 1)
+    return [(*key, *delta) for key, delta in deltas.items()]
+
+
+def get_standings(gameid):
+    """Rows (groupid, gametype, revenue, units, periods) of a game"""
+    return db.query("""SELECT groupid, gametype, revenue, units, periods
+                       FROM standings WHERE gameid=?""", (gameid,))
+
+
+def get_last_result_id(gameid):
+    """Id of the last result row of a game (0 if none)"""
+    return db.query_one("SELECT max(id) FROM results WHERE gameid=?", (gameid,))[0] or 0
+
+
+def get_new_results(gameid, last_id, limit=1000):
+    """Result rows (id, groupid, gametype, period, price) of a game inserted after last_id"""
+    return db.query("""SELECT id, groupid, gametype, period, price FROM results
+                       WHERE gameid=? AND id>? ORDER BY id LIMIT ?""", (gameid, last_id, limit))
+
+
+def get_group_standings(gameid, groups):
+    """Standings rows (groupid, gametype, revenue) for a set of (groupid, gametype)"""
+    rows = db.query("""SELECT groupid, gametype, revenue FROM standings WHERE gameid=?""", (gameid,))
+    return [row for row in rows if (row[0], row[1]) in groups]
+
+
+def delete_game(gameid):
+    """Deletes a game with its results, standings and weekly game states"""
+    with db.transaction() as con:
+        con.execute("DELETE FROM results WHERE gameid = ?", (gameid,))
+        con.execute("DELETE FROM standings WHERE gameid = ?", (gameid,))
+        con.execute("DELETE FROM game_state WHERE gameid = ?", (gameid,))
+        con.execute("DELETE FROM game_steps WHERE gameid = ?", (gameid,))
+        con.execute("DELETE FROM games WHERE gameid = ?", (gameid,))
+        con.execute("""INSERT INTO game_deletions (gameid, deleted, max_id)
+                       SELECT ?, ?, coalesce(max(id), 0) FROM results""", (gameid, time.time()))
+        # the version is kept (and bumped) so cached dashboards of the old game are never reused
+        con.execute(BUMP_VERSION, (gameid, time.time()))
+
+
+def enable_write_behind(interval=0.2, batch_size=200, spill_dir=None):
+    """Queue submissions and write them in batches on a background thread (failed batches go to spill_dir)"""
+    global _write_behind_config
+    _write_behind_config = (interval, batch_size, spill_dir)
+
+
+def replay_spilled(spill_dir):
+    """Inserts the submissions of the batches that the write-behind queue could not write"""
+    return replay(spill_dir, insert_results_batch, PERMANENT_ERRORS)
+
+
+def _get_write_behind():
+    """Write-behind queue of the current process, started on first use (after a fork)"""
+    global WRITE_BEHIND, _write_behind_pid
+    if WRITE_BEHIND is None or _write_behind_pid != os.getpid():
+        interval, batch_size, spill_dir = _write_behind_config
+        WRITE_BEHIND = WriteBehindQueue(insert_results_batch, interval=interval, batch_size=batch_size,
+                                        spill_dir=spill_dir, permanent=PERMANENT_ERRORS)
+        _write_behind_pid = os.getpid()
+    return WRITE_BEHIND
+
+
+def save_results(rows):
+    """Saves the rows of a submission, through the write-behind queue if enabled"""
+    if _write_behind_config is None:
+        insert_results(rows)
+    else:
+        _get_write_behind().submit(rows)
+
+
+def flush_pending():
+    """Writes the submissions queued in this worker, so that they can be read back.
+
+    Waits at most FLUSH_TIMEOUT seconds (a failing batch is being retried):
+    the page is then shown without the submissions still queued."""
+    if WRITE_BEHIND is not None and _write_behind_pid == os.getpid():
+        WRITE_BEHIND.flush(FLUSH_TIMEOUT)
@@ -0,0 +1,56 @@
+# Per-game scenarios
+# Each (gameid, gametype) gets its own reproducible draw of customers and
+# valuations, from a NumPy Generator seeded with SeedSequence([seed, gameid,
+# gametype index]). Every worker derives the same scenario without any
+# coordination, so scenarios are generated on demand and kept in an LRU cache.
+
+import zlib
+
+import numpy as np
+
+from demand import WeeklyDemand
+from lrucache import LRUCache
+
+
+def game_key(gameid):
+    """Non-negative integer identifying a game in the seed (game ids come as strings from forms)"""
+    try:
+        return abs(int(gameid))
+    except (TypeError, ValueError):
+        return zlib.crc32(str(gameid).encode())
+
+
+class ScenarioService:
+    """Demand of every (gameid, gametype), generated on first use"""
+
+    def __init__(self, values, ranges, gamevalues, ncust_range, seed, cache_size=1024):
+        self.values = values            # sorted valuations of the empirical distribution
+        self.ranges = ranges            # valuation type -> (start, stop) indices into values
+        self.gamevalues = gamevalues    # game type -> valuation type of each week
+        self.gametypes = list(gamevalues)
+        self.ncust_range = ncust_range  # (low, high) customers per week, both included
+        self.seed = seed
+        self.cache = LRUCache(cache_size)
+
+    def get(self, gameid, gametype):
+        """WeeklyDemand of a game and game type"""
+        key = (game_key(gameid), gametype)
+        demand = self.cache.get(key)
+        if demand is None:
+            demand = WeeklyDemand(self.generate(*key))
+            self.cache.put(key, demand)
+        return demand
+
+    def generate(self, gamekey, gametype):
+        """List with the array of customer valuations of each week.
+
+        All the weeks are sampled with one call: the customers of each week draw
+        indices into the sorted range of their valuation type."""
+        rng = np.random.default_rng(
+            np.random.SeedSequence([self.seed, gamekey, self.gametypes.index(gametype)]))
+        weektypes = self.gamevalues[gametype]
+        low, high = self.ncust_range
+        ncust = rng.integers(low, high, size=len(weektypes), endpoint=True)
+        bounds = np.array([self.ranges[v] for v in weektypes])
+        idx = rng.integers(np.repeat(bounds[:, 0], ncust), np.repeat(bounds[:, 1], ncust))
+        return np.split(self.values[idx], np.cumsum(ncust)[:-1])
@@ -0,0 +1,136 @@
+# Database schema and migrations
+# The schema version is stored in SQLite's user_version. On startup, migrate()
+# applies the pending migrations in order, each one in its own transaction,
+# so an existing gameresults.sqlite is upgraded in place.
+
+import db
+
+
+def _v1_initial_tables(con):
+    """Original tables (as created by earlier versions of the app)"""
+    con.execute("""CREATE TABLE IF NOT EXISTS results
+                     (timestamp text, gameid text, gametype text, groupid text,
+                      period integer, price real, ncust integer, sales integer, end_inv integer)""")
+    con.execute("""CREATE TABLE IF NOT EXISTS games
+                    (gameid integer, gamestatus text, timestamp text)""")
+
+
+def _v2_typed_indexed_tables(con):
+    """Consistent column types, primary keys and indexes for results and games"""
+    # gameid is an INTEGER in both tables, so that the indexes can be used for the joins and filters
+    con.execute("""CREATE TABLE results_new
+                     (id integer PRIMARY KEY, timestamp text, gameid integer NOT NULL,
+                      gametype text NOT NULL, groupid text NOT NULL, period integer NOT NULL,
+                      price real, ncust integer, sales integer, end_inv integer)""")
+    con.execute("""INSERT INTO results_new
+                     (timestamp, gameid, gametype, groupid, period, price, ncust, sales, end_inv)
+                   SELECT timestamp, CAST(gameid AS integer), gametype, groupid,
+                          CAST(period AS integer), CAST(price AS real),
+                          CAST(ncust AS integer), CAST(sales AS integer),
+                          CASE WHEN end_inv IS NULL OR trim(end_inv) IN ('', 'None') THEN NULL
+                               ELSE CAST(end_inv AS integer) END
+                   FROM results ORDER BY rowid""")
+    con.execute("DROP TABLE results")
+    con.execute("ALTER TABLE results_new RENAME TO results")
+    con.execute("""CREATE INDEX results_game_idx
+                     ON results (gameid, gametype, groupid, period)""")
+
+    # One row per game; if a game was inserted twice, the latest row is kept
+    con.execute("""CREATE TABLE games_new
+                    (gameid integer PRIMARY KEY, gamestatus text NOT NULL, timestamp text)""")
+    con.execute("""INSERT OR REPLACE INTO games_new (gameid, gamestatus, timestamp)
+                   SELECT CAST(gameid AS integer), gamestatus, timestamp
+                   FROM games ORDER BY timestamp""")
+    con.execute("DROP TABLE games")
+    con.execute("ALTER TABLE games_new RENAME TO games")
+    con.execute("CREATE INDEX games_status_idx ON games (gamestatus)")
+
+
+def _v3_game_state_tables(con):
+    """Server-side state of the weekly /<gametype> flow (see gamestate.py)"""
+    con.execute("""CREATE TABLE IF NOT EXISTS game_state
+                   (gameid integer, groupid text, gametype text, week integer,
+                    inv integer, cumsales integer, revenue real, timestamp text,
+                    PRIMARY KEY (gameid, groupid, gametype))""")
+    con.execute("""CREATE TABLE IF NOT EXISTS game_steps
+                   (gameid integer, groupid text, gametype text, week integer,
+                    price real, sales integer, ncust integer, end_inv integer,
+                    PRIMARY KEY (gameid, groupid, gametype, week))""")
+
+
+def _v4_standings_table(con):
+    """Revenue, units and periods per (gameid, groupid, gametype), maintained on insert"""
+    con.execute("""CREATE TABLE standings
+                   (gameid integer NOT NULL, groupid text NOT NULL, gametype text NOT NULL,
+                    revenue real NOT NULL DEFAULT 0, units integer NOT NULL DEFAULT 0,
+                    periods integer NOT NULL DEFAULT 0,
+                    PRIMARY KEY (gameid, groupid, gametype))""")
+    con.execute("""INSERT INTO standings (gameid, groupid, gametype, revenue, units, periods)
+                   SELECT gameid, groupid, gametype, total(price*sales), total(sales), count(*)
+                   FROM results GROUP BY gameid, groupid, gametype""")
+
+
+def _v5_results_id_index(con):
+    """Index to read the results of a game inserted after a given id (dashboard stream)"""
+    con.execute("CREATE INDEX results_game_id_idx ON results (gameid, id)")
+
+
+def _v6_game_versions_table(con):
+    """Results version of each game, bumped on every insert or delete (dashboard cache)"""
+    con.execute("""CREATE TABLE game_versions
+                   (gameid integer PRIMARY KEY, version integer NOT NULL, updated real NOT NULL)""")
+
+
+def _v7_game_deletions_table(con):
+    """Log of deleted games, read by the incremental analytics export (see analytics.py)"""
+    # max_id: largest results id left after the deletion (later inserts may reuse the ids above it)
+    con.execute("""CREATE TABLE game_deletions
+                   (id integer PRIMARY KEY, gameid integer NOT NULL, deleted real NOT NULL,
+                    max_id integer NOT NULL)""")
+
+
+def _v8_games_version_table(con):
+    """Version of the games table, bumped by triggers on every change (open games registry)"""
+    con.execute("""CREATE TABLE games_version
+                   (id integer PRIMARY KEY CHECK (id = 0), version integer NOT NULL)""")
+    con.execute("INSERT INTO games_version (id, version) VALUES (0, 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        con.execute(f"""CREATE TRIGGER games_version_{event.lower()} AFTER {event} ON games
+                        BEGIN UPDATE games_version SET version = version + 1; END""")
+
+
+# Columns of the results table shown to users (without the internal id)
+RESULTS_COLUMNS = "timestamp, gameid, gametype, groupid, period, price, ncust, sales, end_inv"
+
+# Migrations in order; the schema version is the number of migrations applied
+MIGRATIONS = [
+    _v1_initial_tables,
+    _v2_typed_indexed_tables,
+    _v3_game_state_tables,
+    _v4_standings_table,
+    _v5_results_id_index,
+    _v6_game_versions_table,
+    _v7_game_deletions_table,
+    _v8_games_version_table,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version():
+    """Schema version of the database"""
+    return db.query_one("PRAGMA user_version")[0]
+
+
+def migrate():
+    """Upgrades the database to SCHEMA_VERSION and returns the list of migrations applied"""
+    applied = []
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        with db.transaction() as con:
+            # Read the version inside the transaction: another worker may have migrated already
+            if con.execute("PRAGMA user_version").fetchone()[0] >= version:
+                continue
+            migration(con)
+            con.execute(f"PRAGMA user_version={version}")
+        applied.append(migration.__name__)
+    return applied
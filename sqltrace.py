@@ -0,0 +1,183 @@
+# SQL tracing and slow-query log
+# Opt-in (SQL_TRACE=1): every connection opened by db.py gets sqlite3's trace
+# callback, which sees each statement run (with its parameters expanded),
+# and a progress handler, which counts the virtual machine steps as a measure
+# of the work done. The db helpers time their calls and count the rows; the
+# statements that take longer than the threshold are explained with EXPLAIN
+# QUERY PLAN, and full-table scans (e.g. "SCAN results") are flagged.
+# Entries go to the 'sqltrace' logger and to bounded in-memory lists of the
+# worker, shown at /admin/sql_trace.
+
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+ENABLED = False
+SLOW_MS = 100.0         # statements slower than this (milliseconds) are explained
+PROGRESS_OPS = 1000     # virtual machine instructions between calls of the progress handler
+MAX_STATEMENTS = 20     # statements kept per entry (executemany runs one per row)
+RECENT_SIZE = 200       # entries kept in memory
+SLOW_SIZE = 100
+
+_recent = deque(maxlen=RECENT_SIZE)
+_slow = deque(maxlen=SLOW_SIZE)
+_stats = {}             # normalized statement -> totals
+_lock = threading.Lock()
+_local = threading.local()
+_NOTRACE = nullcontext({})
+
+_EXPLAINABLE = re.compile(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b', re.I)
+_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)$')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def configure(enabled, slow_ms=SLOW_MS, log_file=None):
+    """Turns tracing on for the connections opened from now on"""
+    global ENABLED, SLOW_MS
+    ENABLED = enabled
+    SLOW_MS = slow_ms
+    if enabled and log_file:
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(process)d %(levelname)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+
+def attach(con):
+    """Installs the trace callback and the progress handler on a connection"""
+    con.set_trace_callback(_on_statement)
+    con.set_progress_handler(_on_progress, PROGRESS_OPS)
+
+
+def _on_statement(statement):
+    if getattr(_local, 'explaining', False):
+        return
+    entry = getattr(_local, 'entry', None)
+    if entry is None:
+        # run on the connection outside the db helpers: logged without timing
+        entry = _new_entry(statement, ())
+        entry['statements'].append(statement)
+        _finish(entry, None)
+        return
+    entry['nstatements'] += 1
+    if len(entry['statements']) < MAX_STATEMENTS:
+        entry['statements'].append(statement)
+
+
+def _on_progress():
+    entry = getattr(_local, 'entry', None)
+    if entry is not None:
+        entry['steps'] += PROGRESS_OPS
+    return 0
+
+
+def _new_entry(statement, params):
+    return {'time': time.time(), 'statement': statement, 'params': list(params), 'statements': [],
+            'nstatements': 0, 'steps': 0, 'rows': None, 'ms': None, 'plans': {}, 'scans': []}
+
+
+def block(con, statement, params=()):
+    """Context manager tracing a call of a db helper; yields the entry, whose 'rows' the caller sets.
+
+    Nested calls (execute() inside its transaction()) share the outer entry."""
+    if not ENABLED:
+        return _NOTRACE
+    return _block(con, statement, params)
+
+
+@contextmanager
+def _block(con, statement, params):
+    entry = getattr(_local, 'entry', None)
+    if entry is not None:
+        entry['statement'], entry['params'] = statement, list(params)
+        yield entry
+        return
+    _local.entry = entry = _new_entry(statement, params)
+    start = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        ms = (time.perf_counter() - start)*1000
+        _local.entry = None
+        if ms >= SLOW_MS:
+            entry['plans'] = {s: _explain(con, s) for s in dict.fromkeys(entry['statements'])
+                              if _EXPLAINABLE.match(s)}
+        _finish(entry, ms)
+
+
+def _explain(con, statement):
+    """Lines of EXPLAIN QUERY PLAN of a statement (with its parameters expanded)"""
+    _local.explaining = True
+    try:
+        rows = con.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()
+    except Exception as e:
+        return [f"(no plan: {e})"]
+    finally:
+        _local.explaining = False
+    # rows are (id, parent, notused, detail): indent each step under its parent
+    depth = {0: -1}
+    lines = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        lines.append('  '*depth[node] + detail)
+    return lines
+
+
+def normalize(statement):
+    """Statement with literals replaced by ?, to add up the runs of the same query"""
+    return ' '.join(_LITERALS.sub('?', statement).split())
+
+
+def _finish(entry, ms):
+    entry['ms'] = ms
+    entry['scans'] = sorted({m.group(1) for plan in entry['plans'].values()
+                             for line in plan for m in [_FULL_SCAN.match(line.strip())] if m})
+    key = normalize(entry['statement'] if entry['statement'] != 'transaction' or not entry['statements']
+                    else '; '.join(dict.fromkeys(normalize(s) for s in entry['statements'])))
+    slow = ms is not None and ms >= SLOW_MS
+    with _lock:
+        _recent.append(entry)
+        if slow:
+            _slow.append(entry)
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = {'statement': key, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                   'rows': 0, 'steps': 0, 'slow': 0, 'scans': []}
+        stats['count'] += 1
+        stats['total_ms'] += ms or 0.0
+        stats['max_ms'] = max(stats['max_ms'], ms or 0.0)
+        stats['rows'] += entry['rows'] or 0
+        stats['steps'] += entry['steps']
+        stats['slow'] += slow
+        stats['scans'] = sorted(set(stats['scans']) | set(entry['scans']))
+    duration = 'untimed' if ms is None else f"{ms:.1f} ms"
+    message = (f"{duration} rows={entry['rows']} steps={entry['steps']} "
+               f"statements={entry['nstatements'] or len(entry['statements'])} "
+               f"{entry['statement']} params={entry['params']}")
+    if slow:
+        plans = '\n'.join(f"  {s}\n" + '\n'.join(f"    {line}" for line in plan)
+                          for s, plan in entry['plans'].items())
+        logger.warning("slow query: %s%s\n%s", message,
+                       f" FULL SCAN of {', '.join(entry['scans'])}" if entry['scans'] else '', plans)
+    else:
+        logger.info("%s", message)
+
+
+def snapshot():
+    """Statement totals (slowest first), slow entries and recent entries of this worker"""
+    with _lock:
+        stats = sorted((dict(s) for s in _stats.values()), key=lambda s: -s['total_ms'])
+        return {'enabled': ENABLED, 'slow_ms': SLOW_MS, 'statements': stats,
+                'slow': list(_slow)[::-1], 'recent': list(_recent)[::-1]}
+
+
+def reset():
+    with _lock:
+        _recent.clear()
+        _slow.clear()
+        _stats.clear()
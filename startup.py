@@ -0,0 +1,35 @@
+# Timed startup steps
+# main.py runs its initialization (imports, valuations, database, ...) when a
+# worker imports it. Each step ends with checkpoint(name), which records the
+# time since the previous one, and report() prints the breakdown in the
+# format of python -X importtime. Set STARTUP_REPORT=1 to print it on boot.
+
+import os
+import time
+
+STARTED = time.perf_counter()    # main.py imports this module first
+STEPS = []                       # list of (step name, seconds)
+_last = STARTED
+
+
+def checkpoint(name):
+    """Records the time since the previous checkpoint as the step name"""
+    global _last
+    now = time.perf_counter()
+    STEPS.append((name, now - _last))
+    _last = now
+
+
+def total():
+    """Seconds from the start up to the last checkpoint"""
+    return _last - STARTED
+
+
+def report():
+    """Table with the time of each step and the cumulative time, in microseconds"""
+    lines = [f"startup time (pid {os.getpid()}): self [us] | cumulative | step"]
+    cumulative = 0.0
+    for name, seconds in STEPS:
+        cumulative += seconds
+        lines.append(f"startup time: {int(seconds*1e6):>9} | {int(cumulative*1e6):>10} | {name}")
+    return "\n".join(lines)
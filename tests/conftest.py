@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """main.app on a new database (main reads valuations.txt and the templates from the working directory)"""
+    os.environ['GAMEDB'] = str(tmp_path_factory.mktemp('db') / 'gameresults.sqlite')
+    os.chdir(ROOT)
+    import main
+    return main.app
+
+
+@pytest.fixture
+def client(app):
+    import db
+    import main
+    db.configure(main.DATABASE)     # other tests may have pointed db to their own database
+    return app.test_client()
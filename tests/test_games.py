@@ -0,0 +1,118 @@
+import db
+
+
+def test_create_game_twice(client):
+    # a refreshed dashboard resubmits the form that created the game
+    for _ in range(2):
+        response = client.post('/dashboard', data={'gameid': 24680, 'gametype': 'base', 'isnew': 1})
+        assert response.status_code == 200
+    assert db.query("SELECT gamestatus FROM games WHERE gameid=24680") == [('open',)]
+
+
+def test_download_all_rounds(client):
+    client.post('/dashboard', data={'gameid': 13579, 'gametype': 'base', 'isnew': 1})
+    for gametype in ('base', 'inv'):
+        client.post(f'/results/{gametype}', data={'gameid': 13579, 'groupname': 'g1',
+                                                  'price_hist': '800,800,800,800,800,', 'ncust': '30,30,30,30,30',
+                                                  'sales': '5,5,5,5,5', 'end_inv': '35,30,25,20,15'})
+    # the dashboard form sends the gametype shown, the download has every round
+    response = client.post('/download_results', data={'gameid': 13579, 'gametype': 'base'})
+    rows = response.get_data(as_text=True).splitlines()[1:]
+    assert {row.split(',')[2] for row in rows} == {'base', 'inv'}
+
+
+def test_dashboard_streams_are_capped(client):
+    import main
+    streams = [client.get('/dashboard/stream?gameid=13579', buffered=False) for _ in range(main.SSE_MAX_STREAMS)]
+    assert [s.status_code for s in streams] == [200]*main.SSE_MAX_STREAMS
+    # one more dashboard falls back to polling
+    assert client.get('/dashboard/stream?gameid=13579', buffered=False).status_code == 503
+    # a closed stream frees its slot
+    streams.pop().close()
+    stream = client.get('/dashboard/stream?gameid=13579', buffered=False)
+    assert stream.status_code == 200
+    for s in streams + [stream]:
+        s.close()
+
+
+def test_delete_game(client):
+    client.post('/dashboard', data={'gameid': 97531, 'gametype': 'base', 'isnew': 1})
+    client.post('/api/step/inv', data={'gameid': 97531, 'groupname': 'g1', 'stage': 1, 'price': 800})
+    client.post('/results/base', data={'gameid': 97531, 'groupname': 'g1', 'price_hist': '800,800,800,800,800,',
+                                       'ncust': '30,30,30,30,30', 'sales': '5,5,5,5,5'})
+    client.post('/manage_games', data={'gameid': 97531, 'delete': 1})
+    for table in ('games', 'results', 'standings', 'game_state', 'game_steps'):
+        assert db.query(f"SELECT count(*) FROM {table} WHERE gameid=97531") == [(0,)], table
+
+
+def test_dashboard_etag(client):
+    client.post('/dashboard', data={'gameid': 11223, 'gametype': 'base', 'isnew': 1})
+    response = client.get('/dashboard?gameid=11223&gametype=base')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    response = client.get('/dashboard?gameid=11223&gametype=base', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_invalid_results_are_rejected(client):
+    import main
+    data = {'gameid': 13579, 'groupname': 'g1', 'price_hist': '800,800,800,800,800,',
+            'ncust': '30,30,30,30,30', 'sales': '5,5,5,5,5'}
+    for invalid in ({'groupname': ''}, {'price_hist': '800,nan,800,800,800,'}):
+        before = db.query("SELECT count(*) FROM results")
+        response = client.post('/results/base', data=dict(data, **invalid))
+        assert b'invalid results' in response.data
+        main.flush_pending()
+        assert db.query("SELECT count(*) FROM results") == before
+
+
+def test_step_needs_the_previous_weeks(client):
+    client.post('/dashboard', data={'gameid': 86420, 'gametype': 'base', 'isnew': 1})
+    step = {'gameid': 86420, 'groupname': 'g1', 'price': 800}
+    response = client.post('/api/step/inv', data=dict(step, stage=3))
+    assert response.status_code == 400
+    # with the prices of weeks 1 and 2, week 3 is played from the rebuilt state
+    response = client.post('/api/step/inv', data=dict(step, stage=3, price_hist='900,850,'))
+    assert response.status_code == 200
+    assert response.json['week'] == 3
+    assert [s[0] for s in db.query("SELECT week FROM game_steps WHERE gameid=86420 ORDER BY week")] == [1, 2, 3]
+
+
+def test_legacy_results_use_the_stored_weeks(client):
+    client.post('/dashboard', data={'gameid': 75319, 'gametype': 'base', 'isnew': 1})
+    group = {'gameid': 75319, 'groupname': 'g1'}
+    for stage, price in enumerate([900, 850, 800, 750, 700], start=1):
+        client.post('/api/step/inv', data=dict(group, stage=stage, price=price))
+    # the prices of the form disagree with the weeks played: the stored weeks are kept
+    client.post('/results/inv', data=dict(group, price_hist='1,1,1,1,1,'))
+    import main
+    main.flush_pending()
+    assert [r[0] for r in db.query("""SELECT price FROM results WHERE gameid=75319 AND groupid='g1'
+                                      ORDER BY period""")] == [900, 850, 800, 750, 700]
+
+
+def test_legacy_results_without_stored_weeks(client):
+    # e.g. the memory backend, on another worker than the one that played the weeks
+    client.post('/dashboard', data={'gameid': 75320, 'gametype': 'base', 'isnew': 1})
+    response = client.post('/results/inv', data={'gameid': 75320, 'groupname': 'g2',
+                                                 'price_hist': '900,850,800,750,700,'})
+    assert b'Error' not in response.data
+    import main
+    main.flush_pending()
+    rows = db.query("SELECT period, price, sales, end_inv FROM results WHERE gameid=75320 ORDER BY period")
+    assert [r[:2] for r in rows] == [(1, 900), (2, 850), (3, 800), (4, 750), (5, 700)]
+    assert rows[-1][3] == main.INITINV - sum(r[2] for r in rows)
+
+
+def test_metrics_shared_by_the_workers(client):
+    import json
+    import os
+    import metrics
+    assert metrics.METRICS_DIR
+    client.get('/login')
+    # the file of another (live) worker is added to this one's histograms
+    with open(os.path.join(metrics.METRICS_DIR, f'metrics-{os.getppid()}.json'), 'w') as f:
+        json.dump([['/login', 'total', [1] + [0]*(len(metrics.BUCKETS) - 1) + [0.0005, 1]]], f)
+    text = client.get('/metrics').get_data(as_text=True)
+    own = metrics._histograms[('/login', 'total')][-1]
+    assert f'valuation_game_request_duration_seconds_count{{route="/login"}} {own + 1}' in text
@@ -0,0 +1,54 @@
+import sqlite3
+
+import pytest
+
+import db
+import schema
+
+
+@pytest.fixture
+def v1_database(tmp_path):
+    """Database as written by the app before the migrations: text game ids, a game inserted twice"""
+    path = str(tmp_path / 'gameresults.sqlite')
+    con = sqlite3.connect(path)
+    con.execute("""CREATE TABLE results
+                     (timestamp text, gameid text, gametype text, groupid text,
+                      period integer, price real, ncust integer, sales integer, end_inv integer)""")
+    con.execute("CREATE TABLE games (gameid integer, gamestatus text, timestamp text)")
+    con.executemany("INSERT INTO results VALUES (?,?,?,?,?,?,?,?,?)", [
+        ('2023-09-01 10:00:00', '12345', 'base', 'g1', 1, 800.0, 30, 10, None),
+        ('2023-09-01 10:00:00', '12345', 'inv', 'g1', 1, 900.0, 30, 8, '32'),
+        ('2023-09-01 10:00:00', '12345', 'inv', 'g1', 2, 950.0, 25, 7, 'None'),
+        ('2023-09-02 10:00:00', '777', 'base', 'g2', 1, 500.0, 20, 12, ''),
+    ])
+    con.executemany("INSERT INTO games VALUES (?,?,?)", [
+        ('12345', 'open', '2023-09-01 09:00:00'),
+        ('12345', 'closed', '2023-09-03 09:00:00'),
+        (777, 'open', '2023-09-02 09:00:00'),
+    ])
+    con.commit()
+    con.close()
+    db.configure(path)
+    yield path
+    db.close()
+
+
+def test_migrate_v1_database(v1_database):
+    applied = schema.migrate()
+    assert len(applied) == schema.SCHEMA_VERSION
+    assert schema.get_version() == schema.SCHEMA_VERSION
+
+    rows = db.query("SELECT gameid, gametype, groupid, period, end_inv FROM results ORDER BY id")
+    assert rows == [(12345, 'base', 'g1', 1, None), (12345, 'inv', 'g1', 1, 32),
+                    (12345, 'inv', 'g1', 2, None), (777, 'base', 'g2', 1, None)]
+    assert {type(row[0]) for row in rows} == {int}
+
+    # the latest row of the game inserted twice is kept
+    assert db.query("SELECT gameid, gamestatus FROM games ORDER BY gameid") == [(777, 'open'), (12345, 'closed')]
+
+    # standings are built from the existing results
+    assert db.query("""SELECT groupid, gametype, revenue, units, periods FROM standings
+                       WHERE gameid=12345 ORDER BY gametype""") == [('g1', 'base', 8000.0, 10, 1),
+                                                                    ('g1', 'inv', 13850.0, 15, 2)]
+    assert schema.migrate() == []
+
@@ -0,0 +1,70 @@
+import os
+import time
+
+import numpy as np
+
+from writequeue import WriteBehindQueue, replay
+
+
+def test_failed_batch_is_spilled_and_replayed(tmp_path):
+    def failing(batch):
+        raise OSError("disk I/O error")
+
+    q = WriteBehindQueue(failing, interval=0.01, retries=2, spill_dir=str(tmp_path))
+    q.submit([('2024-01-01', 1, 'base', 'g1', 1, np.float64(800.0), np.int64(30), 10, None)])
+    q.flush()
+    q.close()
+    assert len(list(tmp_path.glob('writebehind-*.jsonl'))) == 1
+
+    # the database fails again: the batch is kept
+    assert replay(str(tmp_path), failing) == 0
+    assert len(list(tmp_path.glob('writebehind-*.jsonl'))) == 1
+
+    written = []
+    assert replay(str(tmp_path), written.append) == 1
+    assert written == [[[['2024-01-01', 1, 'base', 'g1', 1, 800.0, 30, 10, None]]]]
+    assert list(tmp_path.iterdir()) == []
+
+
+class Database:
+    """write_batch that fails on the items marked 'bad', like a constraint violation"""
+
+    def __init__(self):
+        self.items = []
+
+    def write_batch(self, batch):
+        if 'bad' in batch:
+            raise ValueError("NOT NULL constraint failed")
+        self.items.extend(batch)
+
+
+def test_bad_item_does_not_sink_its_batch(tmp_path):
+    database = Database()
+    q = WriteBehindQueue(database.write_batch, interval=0.5, retries=1, spill_dir=str(tmp_path),
+                         permanent=(ValueError,))
+    for item in ['good1', 'bad', 'good2']:
+        q.submit(item)
+    assert q.flush(timeout=5)
+    q.close()
+    assert database.items == ['good1', 'good2']
+    assert list(tmp_path.glob('writebehind-*.jsonl')) == []
+    assert len(list(tmp_path.glob('rejected-*.jsonl'))) == 1
+
+
+def test_replay_continues_after_a_bad_batch(tmp_path):
+    with open(tmp_path / 'writebehind-1.jsonl', 'w') as f:
+        f.write('["good1", "bad"]\n["good2"]\n')
+    database = Database()
+    assert replay(str(tmp_path), database.write_batch, permanent=(ValueError,)) == 2
+    assert database.items == ['good1', 'good2']
+    # the bad item is not replayed again
+    assert [p.name for p in tmp_path.iterdir()] == [f'rejected-{os.getpid()}.jsonl']
+    assert replay(str(tmp_path), database.write_batch, permanent=(ValueError,)) == 0
+
+
+def test_flush_timeout():
+    q = WriteBehindQueue(lambda batch: time.sleep(1), interval=0.01)
+    q.submit('slow')
+    assert not q.flush(timeout=0.1)
+    assert q.flush(timeout=5)
+    q.close()
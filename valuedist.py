@@ -0,0 +1,86 @@
+# Empirical distribution of customer valuations
+# Large survey distributions are preprocessed once into a sorted int64 .npy
+# file, with a JSON file of metadata (count, min, max and percentiles) next
+# to it. The .npy is opened with np.load(mmap_mode='r'), so startup does not
+# read it and the pages are shared through the OS page cache by all the
+# gunicorn workers. Text files (one valuation per line) are still accepted.
+#
+# Converter:
+#     python valuedist.py valuations.txt valuations.npy
+
+import json
+import os
+import sys
+
+import numpy as np
+
+
+class ValueDistribution:
+    """Sorted valuations, with the index ranges of the low and high valuation types"""
+
+    def __init__(self, values, meta=None):
+        self.values = values
+        self.meta = meta if meta is not None else describe(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def ranges(self, high_cut):
+        """(start, stop) of each valuation type in values: 'high' is the top high_cut fraction"""
+        numobs = len(self.values)
+        numcut = int(np.floor(numobs*(1 - high_cut)))
+        return {'full': (0, numobs),
+                'high': (numcut, numobs),
+                'low': (0, numcut)}
+
+
+def describe(values):
+    """Metadata of a sorted array of valuations"""
+    return {'count': int(len(values)),
+            'min': int(values[0]),
+            'max': int(values[-1]),
+            # value at every percentile, from 0 to 100 (values are sorted)
+            'percentiles': [int(v) for v in values[np.arange(101)*(len(values) - 1)//100]]}
+
+
+def meta_path(npy_path):
+    return os.path.splitext(npy_path)[0] + '.json'
+
+
+def read_text(path):
+    """Sorted int64 array from a text file with one valuation per line"""
+    values = np.loadtxt(path, dtype=np.int64, ndmin=1)
+    values.sort()
+    return values
+
+
+def convert(text_path, npy_path):
+    """Writes the sorted valuations of a text file to npy_path, with its metadata"""
+    values = read_text(text_path)
+    meta = describe(values)
+    np.save(npy_path, values)
+    with open(meta_path(npy_path), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return meta
+
+
+def load(path):
+    """ValueDistribution of a .npy file (memory-mapped) or a text file"""
+    if path.endswith('.npy'):
+        values = np.load(path, mmap_mode='r')
+        try:
+            with open(meta_path(path)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = None
+        if meta is not None and meta['count'] != len(values):
+            meta = None     # stale metadata (the .npy was rewritten)
+        return ValueDistribution(values, meta)
+    return ValueDistribution(read_text(path))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit("usage: python valuedist.py <valuations.txt> <valuations.npy>")
+    meta = convert(sys.argv[1], sys.argv[2])
+    print(f"Wrote {meta['count']} valuations ({meta['min']} to {meta['max']}) to {sys.argv[2]}")
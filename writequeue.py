@@ -0,0 +1,193 @@
+# Write-behind queue
+# Submissions are accepted immediately and written by a background thread,
+# which groups everything that arrived within an interval (or up to a batch
+# size) into a single transaction. At the end of a round all groups submit
+# within seconds, and one commit per batch avoids queueing on the write lock.
+# The items were acknowledged when they were queued, so a batch that still
+# fails after the retries is never dropped: its items are written one by one
+# and those that fail are appended to a spill file, which replay() writes
+# back (e.g. at the next startup). Items that can never be written (e.g. a
+# constraint violation) go to a separate rejected file instead.
+
+import atexit
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """Queue of items written in batches by write_batch(list_of_items) on a background thread"""
+
+    def __init__(self, write_batch, interval=0.2, batch_size=200, retries=3, spill_dir=None, permanent=()):
+        self.write_batch = write_batch
+        self.interval = interval        # seconds to wait for more items before committing
+        self.batch_size = batch_size    # maximum number of items per commit
+        self.retries = retries
+        self.spill_dir = spill_dir      # where failed items are kept (JSON lines, one batch per line)
+        self.permanent = permanent      # exceptions of items that will never be written (not retried)
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, item):
+        """Adds an item to be written; returns immediately"""
+        if self._stop.is_set():
+            # Queue already closed (interpreter shutting down): write synchronously
+            self._write([item])
+        else:
+            self._queue.put(item)
+
+    def flush(self, timeout=None):
+        """Waits until every item submitted so far has been written; False if timeout seconds passed first"""
+        q = self._queue
+        with q.all_tasks_done:
+            return q.all_tasks_done.wait_for(lambda: not q.unfinished_tasks, timeout)
+
+    def close(self):
+        """Writes the pending items and stops the background thread"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        # Items submitted while stopping
+        self._drain()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+        self._drain()
+
+    def _drain(self):
+        """Writes whatever is left in the queue"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write(self, batch):
+        error = self._try(batch, self.retries)
+        if error is None:
+            return
+        if len(batch) > 1:
+            # one bad item must not sink the others of its batch: write them one at a time
+            errors = [(item, self._try([item], 1)) for item in batch]
+        else:
+            errors = [(batch[0], error)]
+        for item, error in errors:
+            if error is not None:
+                self._spill([item], 'rejected' if isinstance(error, self.permanent) else 'writebehind')
+
+    def _try(self, batch, attempts):
+        """Writes a batch; returns None, or the exception of the last attempt"""
+        for attempt in range(1, attempts + 1):
+            try:
+                self.write_batch(batch)
+                return None
+            except Exception as e:
+                logger.exception("Write-behind batch of %d items failed (attempt %d of %d)",
+                                 len(batch), attempt, attempts)
+                if isinstance(e, self.permanent):
+                    return e
+                error = e
+                if attempt < attempts:
+                    time.sleep(0.1*attempt)
+        return error
+
+    def _spill(self, items, kind):
+        """Appends failed items to the spill file of this process (kind: 'writebehind' or 'rejected')"""
+        if self.spill_dir:
+            try:
+                path = os.path.join(self.spill_dir, f'{kind}-{os.getpid()}.jsonl')
+                _append(path, [items])
+                logger.error("%d write-behind items spilled to %s", len(items), path)
+                return
+            except OSError:
+                logger.exception("Could not spill the write-behind items")
+        logger.error("Lost write-behind items: %r", items)
+
+
+def _append(path, batches):
+    """Appends batches to a JSON lines file, on disk when it returns"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        f.writelines(json.dumps(batch, default=_to_json) + '\n' for batch in batches)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _to_json(value):
+    """numpy scalars (prices, sales) as Python numbers"""
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def replay(spill_dir, write_batch, permanent=()):
+    """Writes the items spilled in spill_dir; returns the number of items written.
+
+    Each file is renamed before it is read, so that only one process replays it.
+    A batch that fails is retried item by item: items that fail with a
+    permanent error go to a rejected-<pid>.jsonl file, which is not replayed,
+    and the others are kept for the next replay."""
+    written = 0
+    for path in sorted(glob.glob(os.path.join(spill_dir, 'writebehind-*.jsonl'))):
+        claimed = f'{path}.replay-{os.getpid()}'
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            continue    # claimed by another process
+        with open(claimed) as f:
+            batches = [json.loads(line) for line in f if line.strip()]
+        kept, rejected = [], []
+        for batch in batches:
+            try:
+                write_batch(batch)
+                written += len(batch)
+                continue
+            except Exception:
+                logger.exception("Replay of a batch of %d items from %s failed", len(batch), path)
+            for item in batch:
+                try:
+                    write_batch([item])
+                    written += 1
+                except permanent:
+                    logger.exception("Spilled item rejected: %r", item)
+                    rejected.append([item])
+                except Exception:
+                    kept.append([item])
+        if kept:
+            _append(path, kept)
+        if rejected:
+            _append(os.path.join(spill_dir, f'rejected-{os.getpid()}.jsonl'), rejected)
+        os.remove(claimed)
+    return written